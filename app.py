@@ -1,7 +1,6 @@
 import streamlit as st
 import sys
 import os
-from pathlib import Path
 import pandas as pd
 import importlib.util
 import base64
@@ -9,103 +8,78 @@ from io import BytesIO
 import numpy as np
 from PIL import Image
 import pydicom
-import shutil 
-from pydicom.pixel_data_handlers.util import apply_voi_lut
 import matplotlib.pyplot as plt
-from process import get_fhir_data, convert_dicom_to_image, converter_path, main_module
+from process import get_fhir_data, invalidate_fhir_data, fetch_image, fetch_image_columns, main_module
+from dead_letter import DEAD_LETTER_PATH
+from pipeline import CONCURRENCY
+from metrics import REGISTRY
 
 
 async def convert_to_fhir(uploaded_files):
-    """Convert uploaded DICOM files to FHIR"""
-    temp_dir = Path(converter_path) / "temp"
-    st.write(f"Processing {len(uploaded_files)} files")
-    st.write(f"Converter path: {converter_path}")
-    
-    # Clean and create temp directory
-    if temp_dir.exists():
-        shutil.rmtree(temp_dir)
-    temp_dir.mkdir(exist_ok=True)
-    
-    saved_files = []
-    
+    """Convert uploaded DICOM files to FHIR, straight from the upload buffers"""
+    sources = {}
     for uploaded_file in uploaded_files:
-        # Debug the file content
-        st.write(f"File details - Name: {uploaded_file.name}, Size: {uploaded_file.size} bytes")
-        try:
-            # Verify it's a valid DICOM file
-            dicom_data = pydicom.dcmread(uploaded_file)
-            st.write(f"Valid DICOM file detected: {uploaded_file.name}")
-        except Exception as e:
-            st.error(f"Invalid DICOM file {uploaded_file.name}: {str(e)}")
-            continue
-        
-        file_name = uploaded_file.name
-        if not file_name.lower().endswith('.dcm'):
-            file_name = f"{file_name}.dcm"
-        
-        file_path = temp_dir / file_name
-        st.write(f"Saving to: {file_path}")
-        
-        with open(file_path, "wb") as f:
-            file_content = uploaded_file.getvalue()
-            f.write(file_content)
-            st.write(f"Saved {len(file_content)} bytes")
-        
-        saved_files.append(file_name)
-    
-    # Verify files in temp directory
-    actual_files = list(temp_dir.glob("*"))
-    st.write("Files in temp directory:")
-    for file in actual_files:
-        st.write(f"- {file.name} ({file.stat().st_size} bytes)")
-        # Verify file is readable as DICOM
-        try:
-            dicom_data = pydicom.dcmread(file)
-            st.write(f"  ✓ Successfully verified as DICOM")
-        except Exception as e:
-            st.write(f"  ✗ Failed DICOM verification: {str(e)}")
-    
+        # Two uploads may share a name; keep both
+        name = uploaded_file.name
+        if name in sources:
+            name = f"{name} ({len(sources)})"
+        sources[name] = uploaded_file
+
     try:
-        st.write("Starting conversion...")
-        # st.write(f"Calling main_module.main with path: {str(temp_dir)}")
-        processed_files = await main_module.main(str(temp_dir))
-        
+        # Show the timings of this conversion only; the registry is shared by every session
+        before = REGISTRY.snapshot()
+        processed_files = await main_module.main(sources=sources, concurrency=CONCURRENCY)
+
         if processed_files:
             st.success(f"Successfully converted {len(processed_files)} DICOM files to FHIR!")
-            for file in processed_files:
-                st.write(f"Processed: {file}")
         else:
             st.warning("No DICOM files were processed.")
-            # st.write("Troubleshooting information:")
-            # st.write(f"- Temp directory: {temp_dir}")
-            # st.write(f"- Files saved: {saved_files}")
-            # st.write(f"- Files found: {actual_files}")
+        failed_files = [name for name in sources if name not in processed_files]
+        if failed_files:
+            st.warning(f"Skipped {len(failed_files)} files that could not be converted")
+            with st.expander("Skipped files"):
+                st.text("\n".join(failed_files) + f"\n\nSee {DEAD_LETTER_PATH} for the reasons.")
+        with st.expander("Conversion details"):
+            st.text("\n".join(f"Processed: {file}" for file in processed_files))
+            st.json(REGISTRY.since(before).as_dict())
     except Exception as e:
-        st.error(f"Error during conversion: {str(e)}")
-        st.write(f"Error type: {type(e).__name__}")
+        st.error(f"Error during conversion: {type(e).__name__}: {str(e)}")
         import traceback
-        st.write("Traceback:", traceback.format_exc())
+        with st.expander("Traceback"):
+            st.code(traceback.format_exc())
     finally:
-        # Cleanup
-        if temp_dir.exists():
-            shutil.rmtree(temp_dir)
+        # Even a partial run may have written resources
+        invalidate_fhir_data()
 
-def convert_dicom_to_image(image_data, output_format="WEBP"):
-    try:
-        # Decode base64 string to bytes
-        image_bytes = base64.b64decode(image_data)
-        
-        # Open the image directly with PIL
-        image = Image.open(BytesIO(image_bytes))
-        
-        # Convert to output format
-        buffer = BytesIO()
-        image.save(buffer, format=output_format)
-        image_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return image_string, image
-    except Exception as e:
-        print(f"Error converting image: {str(e)}")
-        return None, None
+# Thumbnails shown above the record selector
+THUMBNAILS_SHOWN = 24
+IMAGE_COLUMNS = ['image_data', 'preview_data', 'thumbnail_data']
+
+
+def load_images(report_ids):
+    """Image columns of the given records, fetched the first time they are shown.
+
+    The listing carries no presentedForm, so only these rows are read; their
+    renditions are kept in the session, their full images are not.
+    """
+    images = st.session_state.setdefault('images', {})
+    missing = [report_id for report_id in report_ids if report_id not in images]
+    if missing:
+        for report_id, columns in fetch_image_columns(missing).items():
+            images[report_id] = dict(columns, image_data=None)
+    return [images.get(report_id, {}) for report_id in report_ids]
+
+
+def full_image(report_id, columns):
+    """Base64 full-resolution image of the selected record, fetched once per selection"""
+    cached = st.session_state.get('full_image')
+    if not cached or cached[0] != report_id:
+        if columns.get('image_url'):
+            data = fetch_image(columns['image_url'])
+        else:
+            data = fetch_image_columns([report_id]).get(report_id, {}).get('image_data')
+        cached = st.session_state['full_image'] = (report_id, data)
+    return cached[1]
 
 
 def main():
@@ -129,16 +103,19 @@ def main():
     st.subheader("FHIR Data Preview")
     if st.button("Show Data"):
         with st.spinner("Fetching data..."):
-            records = get_fhir_data()
+            # The listing leaves out presentedForm; the viewer fetches images per row
+            records = get_fhir_data(images=False)
             if records:
                 df = pd.DataFrame(records)
                 
                 # Store the DataFrame in the session state
                 st.session_state['df'] = df
+                st.session_state['images'] = {}
+                st.session_state.pop('full_image', None)
                 st.session_state['show_data'] = True  # Add flag to maintain state
 
-                # Display the DataFrame without the image data column
-                display_df = df.drop(columns=['image_data'])
+                # Display the DataFrame without the image data columns
+                display_df = df.drop(columns=IMAGE_COLUMNS, errors='ignore')
                 # st.dataframe(display_df, use_container_width=True)
 
                 # Show the total number of records
@@ -157,6 +134,14 @@ def main():
     if 'df' in st.session_state:
         st.header("Image Viewer")
         df = st.session_state['df']
+
+        if len(df):
+            shown = load_images(list(df['sopinstanceUID'][:THUMBNAILS_SHOWN]))
+            thumbnails = [(i, columns['thumbnail_data']) for i, columns in enumerate(shown)
+                          if columns.get('thumbnail_data')]
+            if thumbnails:
+                st.image([base64.b64decode(data) for _, data in thumbnails],
+                         caption=[f"Record {i + 1}" for i, _ in thumbnails], width=96)
         
         # Create two columns - one for the selector and one for the download button
         col1, col2 = st.columns([3, 1])
@@ -169,29 +154,28 @@ def main():
             )
 
         if selected_row is not None:
-            image_data = df.iloc[selected_row]['image_data']
-            if image_data:
+            report_id = df.iloc[selected_row]['sopinstanceUID']
+            columns = load_images([report_id])[0]
+            if any(columns.values()):
                 try:
-                    st.write(f"Processed image for record {selected_row + 1}")
-                    image_string, pil_image = convert_dicom_to_image(image_data)
-                    if image_string:
-                        st.image(BytesIO(base64.b64decode(image_string)), caption=f"DICOM Image - Record {selected_row + 1}")
-                        
-                        # Add download button in the second column
-                        with col2:
-                            # Convert PIL image to bytes
-                            img_byte_arr = BytesIO()
-                            pil_image.save(img_byte_arr, format='WEBP')
-                            img_byte_arr = img_byte_arr.getvalue()
-                            
-                            st.download_button(
-                                label="⬇️ Download Image",
-                                data=img_byte_arr,
-                                file_name=f"dicom_image_{selected_row + 1}.webp",
-                                mime="image/webp",
-                            )
-                    else:
-                        st.error("Failed to convert image data")
+                    # Renditions are stored ready to display, so they are shown as they are; a record
+                    # from before they existed shows its inline image
+                    display_data = columns.get('preview_data') or (
+                        None if columns.get('image_url') else full_image(report_id, columns))
+                    if display_data:
+                        st.image(base64.b64decode(display_data), caption=f"DICOM Image - Record {selected_row + 1}")
+
+                    # Add download button in the second column
+                    with col2:
+                        # Full resolution is only fetched for the selected record
+                        image_data = full_image(report_id, columns)
+                        content_type = columns.get('image_content_type') or "image/png"
+                        st.download_button(
+                            label="⬇️ Download Image",
+                            data=base64.b64decode(image_data),
+                            file_name=f"dicom_image_{selected_row + 1}.{content_type.split('/')[-1]}",
+                            mime=content_type,
+                        )
                 except Exception as e:
                     st.error(f"Error displaying image: {str(e)}")
                     st.write("Error details:", str(e))
@@ -201,10 +185,10 @@ def main():
     # Download CSV section
     if st.button("Download as CSV"):
         with st.spinner("Preparing CSV..."):
-            records = get_fhir_data()
+            records = get_fhir_data(images=False)
             if records:
                 df = pd.DataFrame(records)
-                df_for_csv = df.drop(columns=['image_data'])
+                df_for_csv = df.drop(columns=IMAGE_COLUMNS, errors='ignore')
                 csv = df_for_csv.to_csv(index=False)
                 st.download_button(
                     label="Click to Download",
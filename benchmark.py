@@ -0,0 +1,148 @@
+"""Conversion and query benchmarks against an in-process mock FHIR server.
+
+    python benchmark.py --instances 200 --size 512 --latency 5
+    python benchmark.py --modality CR --studies 4 --concurrency 8 --bundle-type batch --batch-size 20
+
+Synthetic datasets are generated with synthetic.generate, so neither the HAPI stack
+nor real DICOM files are needed. Each stage is timed on its own:
+
+    parse      read_dataset (headers; pixels are deferred)
+    render     convert_dicom_to_renditions (full image, preview, thumbnail)
+    serialize  build_resources without images, plus JSON encoding
+    upload     PUTs (or Bundles) of the prebuilt resources
+    ingest     main.main end to end
+    flatten    query.flatten_report over prefetched search pages
+    query      process.get_fhir_data from a cold cache
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from mock_fhir import MockFHIRServer
+from synthetic import generate
+
+
+class Stages:
+    """Wall time and request count per named stage"""
+
+    def __init__(self, server):
+        self.server = server
+        self.results = OrderedDict()
+
+    def time(self, name, func, *args, **kwargs):
+        requests_before = self.server.request_count
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.results[name] = {
+            "seconds": time.perf_counter() - started,
+            "requests": self.server.request_count - requests_before,
+        }
+        return result
+
+
+def report(results, files, total_mb):
+    print(f"{files} files, {total_mb:.1f} MB")
+    print(f"{'stage':<10} {'seconds':>9} {'ms/file':>9} {'files/s':>9} {'requests':>9}")
+    for name, result in results.items():
+        seconds = max(result["seconds"], 1e-9)
+        print(f"{name:<10} {seconds:>9.3f} {1000 * seconds / files:>9.2f} {files / seconds:>9.1f} "
+              f"{result['requests']:>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DICOM conversion and FHIR queries.")
+    parser.add_argument("--modality", choices=["CT", "CR"], default="CT")
+    parser.add_argument("--studies", type=int, default=1)
+    parser.add_argument("--series", type=int, default=1, help="series per study")
+    parser.add_argument("--instances", type=int, default=50, help="instances per series")
+    parser.add_argument("--size", type=int, default=512, help="rows and columns of each image")
+    parser.add_argument("--frames", type=int, default=1, help="frames per instance; above 1 writes Enhanced CT")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock server latency per request, in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, up to this many ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with a 503")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--bundle-type", choices=["transaction", "batch"])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--pixel-format", help="PNG, WEBP or JPEG2000 to store pixels as a Binary")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory, \
+            MockFHIRServer(args.latency / 1000, args.jitter / 1000, args.error_rate) as server:
+        paths = generate(os.path.join(directory, "dicom"), args.modality, args.studies, args.series,
+                         args.instances, args.size, frames=args.frames)
+        total_mb = sum(os.path.getsize(path) for path in paths) / (1024 * 1024)
+
+        # The converter modules read the server URL when imported
+        os.environ["local_url"] = server.url
+        import main
+        import process
+        import query
+        from record_cache import RecordCache
+        from retry import RetryingFHIRClient
+        logging.getLogger().setLevel(logging.WARNING)
+
+        client = RetryingFHIRClient(url=server.url, extra_headers={"Content-Type": "application/fhir+json"})
+        stages = Stages(server)
+        datasets = stages.time("parse", lambda: [process.read_dataset(path) for path in paths])
+        render_format = args.pixel_format or "PNG"
+        stages.time("render", lambda: [process.convert_dicom_to_renditions(ds, format=render_format)
+                                       for ds in datasets])
+        stages.time("serialize", lambda: [json.dumps(main.build_resources(ds, images=False))
+                                          for ds in datasets])
+
+        resources = [main.build_resources(ds, args.pixel_format) for ds in datasets]
+
+        def upload():
+            if not args.bundle_type:
+                for file_resources in resources:
+                    main.save_resources(client, file_resources)
+                return
+            for i in range(0, len(resources), args.batch_size):
+                batch = [resource for file_resources in resources[i:i + args.batch_size]
+                         for resource in file_resources]
+                client.execute("/", method="post", data=main.make_bundle(batch, args.bundle_type))
+
+        stages.time("upload", upload)
+        stages.time("ingest", lambda: asyncio.run(main.main(
+            os.path.join(directory, "dicom"), bundle_type=args.bundle_type, batch_size=args.batch_size,
+            concurrency=args.concurrency, workers=args.workers, pixel_format=args.pixel_format,
+            manifest_path=None, dead_letter_path=os.path.join(directory, "dead_letter.jsonl"))))
+
+        def prefetch():
+            pages = []
+            params = dict(query.REPORT_SEARCH_PARAMS, _count=query.PAGE_SIZE)
+            for bundle in query.iter_bundles(client, "DiagnosticReport", params):
+                index = {}
+                query.index_bundle(index, bundle)
+                reports = [entry["resource"] for entry in bundle.get("entry", [])
+                           if entry.get("search", {}).get("mode") != "include"]
+                query.resolve_page(client, index, reports)
+                pages.append((reports, index))
+            return pages
+
+        pages = prefetch()
+        stages.time("flatten", lambda: [query.flatten_report(report, index)
+                                        for reports, index in pages for report in reports])
+        # A fresh in-memory cache, so the query is cold and a configured on-disk cache is left alone
+        process.record_cache = RecordCache()
+        stages.time("query", process.get_fhir_data)
+
+    report(stages.results, len(paths), total_mb)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"files": len(paths), "megabytes": total_mb, "arguments": vars(args),
+                       "stages": stages.results}, f, indent=2)
+    return stages.results
+
+
+if __name__ == "__main__":
+    run(parse_args())
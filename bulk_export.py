@@ -0,0 +1,172 @@
+import gzip
+import io
+import logging
+import os
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from dead_letter import DeadLetterLog, DEAD_LETTER_PATH
+from discovery import find_dicom_files
+from metrics import REGISTRY
+from pipeline import parse_batch, read_batch
+from resource_cache import ResourceCache
+from streaming import JSONStream
+
+logger = logging.getLogger(__name__)
+
+# gzip, zstd (needs `zstandard`) or none
+COMPRESSION = os.environ.get("ndjson_compression", "gzip")
+SUFFIXES = {"gzip": ".ndjson.gz", "zstd": ".ndjson.zst", "none": ".ndjson"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Resources per output file before a new part is started
+SHARD_LINES = 100000
+
+
+def open_output(path, compression):
+    if compression == "gzip":
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        import zstandard
+
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, "wb")),
+                                encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+class NDJSONWriter:
+    """Streams resources into one NDJSON file per resource type, as Bulk Data $import expects.
+
+    Files are named <Type>.<shard>.<part><suffix>. The shard id is unique to the writer,
+    so any number of writers can share an output directory, and a new part is started
+    every `max_lines` resources. Files are written under a .part name and renamed
+    once complete, so a loader never picks up a half-written file; if the export
+    fails, its .part files are deleted instead.
+    """
+
+    def __init__(self, directory, compression=COMPRESSION, shard=None, max_lines=SHARD_LINES):
+        if compression not in SUFFIXES:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(SUFFIXES)}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = compression
+        self.shard = shard or uuid.uuid4().hex[:12]
+        self.max_lines = max_lines
+        self.outputs = {}  # resource type: [file, path, lines, part]
+        self.counts = Counter()
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, resource):
+        resource_type = resource["resourceType"]
+        output = self.outputs.get(resource_type)
+        if output is None or output[2] >= self.max_lines:
+            part = output[3] + 1 if output else 0
+            if output:
+                self.finish(output)
+            path = os.path.join(self.directory,
+                                f"{resource_type}.{self.shard}.{part:03d}{SUFFIXES[self.compression]}")
+            output = self.outputs[resource_type] = [open_output(path + ".part", self.compression), path, 0, part]
+        # Streamed, so base64 payloads are encoded straight into the (compressed) file
+        line = JSONStream(resource)
+        for chunk in line:
+            output[0].write(chunk.decode("ascii"))
+        output[0].write("\n")
+        output[2] += 1
+        self.counts[resource_type] += 1
+        REGISTRY.count("ndjson_bytes_total", len(line) + 1, resource=resource_type)
+
+    def finish(self, output):
+        output[0].close()
+        os.replace(output[1] + ".part", output[1])
+        self.paths.append(output[1])
+
+    def close(self):
+        for output in self.outputs.values():
+            self.finish(output)
+        self.outputs = {}
+        return self.paths
+
+    def discard(self):
+        """Close the files still being written and delete them, leaving only the finished parts"""
+        for output in self.outputs.values():
+            output[0].close()
+            os.remove(output[1] + ".part")
+        self.outputs = {}
+
+
+def export(directory_path, output_dir, files=None, compression=COMPRESSION, workers=None, batch_size=1,
+           pixel_format=None, images=True, dead_letter_path=DEAD_LETTER_PATH):
+    """Convert the DICOM files under directory_path into NDJSON files instead of uploading them.
+
+    Files are parsed by `workers` processes (inline with workers=1), with at most two
+    batches per worker in flight, and written by this process as they arrive. Shared
+    parents are written once per content change, and each study's aggregated
+    ImagingStudy only once, at the end. Returns the files converted.
+    """
+    files = find_dicom_files(directory_path) if files is None else files
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    workers = workers or os.cpu_count()
+    cache = ResourceCache()
+    dead_letter = DeadLetterLog(dead_letter_path)
+    processed_files = []
+    logger.info(f"Exporting {len(files)} files to {output_dir} as {compression} NDJSON with {workers} workers")
+
+    def merged(results):
+        """A worker's parse results, once its metrics are merged into this process's registry"""
+        batch_results, worker_metrics, _ = results
+        REGISTRY.merge(worker_metrics)
+        return batch_results
+
+    def write_batch(writer, batch, batch_results):
+        for dicom_file, (_, resources, error) in zip(batch, batch_results):
+            if error:
+                dead_letter.record(os.path.join(directory_path, dicom_file), "parse", error)
+                continue
+            # Studies are still aggregated here, but written once complete
+            pending = [resource for resource in cache.unwritten(resources)
+                       if resource["resourceType"] != "ImagingStudy"]
+            for resource in pending:
+                writer.write(resource)
+            cache.added(resources)
+            cache.written(pending)
+            processed_files.append(dicom_file)
+            REGISTRY.count("files_processed_total")
+
+    def paths(batch):
+        return [os.path.join(directory_path, f) for f in batch]
+
+    with NDJSONWriter(output_dir, compression) as writer:
+        if workers == 1:
+            for batch in batches:
+                # Parsed in this process, so its metrics are already in REGISTRY
+                write_batch(writer, batch, parse_batch(paths(batch), pixel_format, images))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = {}
+                remaining = iter(batches)
+                for batch in remaining:
+                    pending[pool.submit(read_batch, paths(batch), pixel_format, images)] = batch
+                    if len(pending) < 2 * workers:
+                        continue
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write_batch(writer, pending.pop(future), merged(future.result()))
+                for future in list(pending):
+                    write_batch(writer, pending.pop(future), merged(future.result()))
+        for study in cache.stale_studies():
+            writer.write(study)
+        writer.close()
+        logger.info(f"Wrote {sum(writer.counts.values())} resources "
+                    f"({', '.join(f'{count} {name}' for name, count in sorted(writer.counts.items()))}) "
+                    f"to {len(writer.paths)} files")
+    return processed_files
@@ -0,0 +1,137 @@
+"""Headless bulk ingestion of DICOM directory trees.
+
+    python cli.py /data/pacs-export --workers 8 --batch-size 50 --bundle-type transaction
+    python cli.py /media/cdrom/DICOMDIR --dry-run
+    python cli.py /data/pacs-export --output-dir export/ --compression zstd
+    python cli.py /data/incoming --watch --batch-size 20 --bundle-type batch
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from discovery import resolve_input
+from bulk_export import COMPRESSION, SUFFIXES
+from dead_letter import DEAD_LETTER_PATH
+from main import PIXEL_FORMAT, MANIFEST_PATH, main as convert
+from metrics import METRICS_PATH, profiled
+from pipeline import CONCURRENCY, read_resources
+import watcher
+
+logger = logging.getLogger(__name__)
+
+
+def check_file(full_path, pixel_format=None, images=True):
+    """Dry-run stage: build a file's resources without uploading; returns the error, if any"""
+    try:
+        read_resources(full_path, pixel_format, images)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def dry_run(directory_path, files, workers=None, batch_size=1, pixel_format=None, images=True):
+    """Parse every file in a process pool and return the ones that converted cleanly"""
+    full_paths = [os.path.join(directory_path, f) for f in files]
+    converted = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        errors = pool.map(check_file, full_paths, [pixel_format] * len(files), [images] * len(files),
+                          chunksize=max(batch_size, 1))
+        for dicom_file, error in zip(files, errors):
+            if error:
+                logger.error(f"Would fail on {dicom_file}: {error}")
+            else:
+                converted.append(dicom_file)
+    return converted
+
+
+def report(action, directory_path, files, seconds):
+    total_mb = sum(os.path.getsize(os.path.join(directory_path, f)) for f in files) / (1024 * 1024)
+    seconds = max(seconds, 1e-9)
+    logger.info(f"{action} {len(files)} files ({total_mb:.1f} MB) in {seconds:.1f}s: "
+                f"{len(files) / seconds:.1f} files/s, {total_mb / seconds:.2f} MB/s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert DICOM files to FHIR and push them to the server.")
+    parser.add_argument("paths", nargs="+", help="directories (walked recursively), DICOMDIR files or DICOM files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parse processes (default: CPU count)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help="parallel uploads; 1 converts sequentially (default: fhir_concurrency or 8)")
+    parser.add_argument("--batch-size", type=int, default=1, help="files per parse batch and per Bundle")
+    parser.add_argument("--bundle-type", choices=["transaction", "batch"], help="post each batch as one Bundle")
+    parser.add_argument("--pixel-format", default=PIXEL_FORMAT, help="store pixels once as a Binary in this format")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="SQLite manifest used to skip pushed files")
+    parser.add_argument("--dead-letter", default=DEAD_LETTER_PATH, help="JSONL file listing the files that failed")
+    parser.add_argument("--metrics", default=METRICS_PATH,
+                        help="write timings and counters here: JSON for .json, Prometheus text otherwise")
+    parser.add_argument("--profile", help="profile the run: pyinstrument HTML for .html, cProfile stats otherwise")
+    parser.add_argument("--no-images", dest="images", action="store_false", help="convert metadata only")
+    parser.add_argument("--dry-run", action="store_true", help="find and parse the files without uploading")
+    parser.add_argument("--output-dir", help="write NDJSON files per resource type here instead of uploading")
+    parser.add_argument("--compression", choices=sorted(SUFFIXES), default=COMPRESSION,
+                        help="compression of the NDJSON files (default: ndjson_compression or gzip)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and convert files as they are dropped into the directories")
+    parser.add_argument("--poll-interval", type=float, default=watcher.POLL_INTERVAL,
+                        help="seconds between looks at the watched directories")
+    parser.add_argument("--settle", type=float, default=watcher.SETTLE_SECONDS,
+                        help="seconds a file must stay unchanged before it is converted")
+    parser.add_argument("--batch-files", type=int, default=watcher.BATCH_FILES,
+                        help="convert a study's new files once this many have arrived")
+    parser.add_argument("--batch-seconds", type=float, default=watcher.BATCH_SECONDS,
+                        help="...or once the first of them has waited this long")
+    args = parser.parse_args(argv)
+    if args.watch and (args.dry_run or args.output_dir):
+        parser.error("--watch cannot be combined with --dry-run or --output-dir")
+    if args.watch and not all(os.path.isdir(path) for path in args.paths):
+        parser.error("--watch needs directories")
+    return args
+
+
+async def run_watch(args):
+    """Watch the directories until SIGINT or SIGTERM, then convert what has already arrived and stop"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:  # Windows; Ctrl+C then stops without the final batch
+            pass
+    converted = await watcher.watch(args.paths, stop, args.poll_interval, args.settle, args.batch_files,
+                                    args.batch_seconds, manifest_path=args.manifest or watcher.WATCH_MANIFEST_PATH,
+                                    bundle_type=args.bundle_type, batch_size=args.batch_size,
+                                    concurrency=args.concurrency, pixel_format=args.pixel_format,
+                                    images=args.images, workers=args.workers, dead_letter_path=args.dead_letter,
+                                    metrics_path=args.metrics)
+    logger.info(f"Stopped watching after converting {converted} files")
+
+
+async def run(args):
+    if args.watch:
+        return await run_watch(args)
+    for path in args.paths:
+        directory_path, files = resolve_input(path)
+        logger.info(f"Found {len(files)} DICOM files in {path}")
+        started = time.perf_counter()
+        if args.dry_run:
+            processed_files = dry_run(directory_path, files, args.workers, args.batch_size, args.pixel_format,
+                                      args.images)
+            report("Parsed", directory_path, processed_files, time.perf_counter() - started)
+            continue
+        processed_files = await convert(directory_path, bundle_type=args.bundle_type, batch_size=args.batch_size,
+                                        concurrency=args.concurrency, pixel_format=args.pixel_format,
+                                        manifest_path=args.manifest, images=args.images, files=files,
+                                        workers=args.workers, dead_letter_path=args.dead_letter,
+                                        metrics_path=args.metrics, output_dir=args.output_dir,
+                                        compression=args.compression)
+        report("Exported" if args.output_dir else "Converted", directory_path, processed_files, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with profiled(args.profile):
+        asyncio.run(run(args))
@@ -0,0 +1,39 @@
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# JSON Lines file collecting the files that could not be converted
+DEAD_LETTER_PATH = os.environ.get("dead_letter_path", "dead_letter.jsonl")
+
+
+class DeadLetterLog:
+    """Append-only JSONL record of failed files, with the stage and reason.
+
+    The file is only created once something fails, and one line is written per
+    failure so a crashed run still leaves a complete record.
+    """
+
+    def __init__(self, path=DEAD_LETTER_PATH):
+        self.path = path
+        self.count = 0
+
+    def record(self, full_path, stage, error):
+        logger.error(f"Failed to {stage} {full_path}: {error}")
+        self.count += 1
+        REGISTRY.count("files_failed_total", stage=stage)
+        if not self.path:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps({
+                # In-memory uploads are recorded by name
+                "path": os.path.abspath(full_path) if os.path.exists(full_path) else full_path,
+                "stage": stage,
+                "error": str(error),
+                "error_type": type(error).__name__,
+                "failed_at": datetime.now(timezone.utc).isoformat(),
+            }) + "\n")
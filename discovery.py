@@ -0,0 +1,62 @@
+import logging
+import os
+
+import pydicom
+
+logger = logging.getLogger(__name__)
+
+# Part 10 files start with a 128-byte preamble followed by this prefix
+DICOM_PREFIX = b"DICM"
+PREAMBLE_LENGTH = 128
+DICOMDIR_NAME = "DICOMDIR"
+
+
+def is_dicom_file(full_path):
+    """True for a .dcm file or, whatever its name, a file with the DICM preamble"""
+    if full_path.lower().endswith(".dcm"):
+        return True
+    try:
+        with open(full_path, "rb") as f:
+            f.seek(PREAMBLE_LENGTH)
+            return f.read(len(DICOM_PREFIX)) == DICOM_PREFIX
+    except OSError:
+        return False
+
+
+def dicomdir_files(dicomdir_path):
+    """Paths, relative to the DICOMDIR's directory, of the instances it references"""
+    dicomdir = pydicom.dcmread(dicomdir_path, stop_before_pixels=True)
+    for record in dicomdir.get("DirectoryRecordSequence", []):
+        file_id = record.get("ReferencedFileID")
+        if file_id:
+            # A single-component ID is read as a plain string
+            yield os.path.join(*([file_id] if isinstance(file_id, str) else file_id))
+
+
+def find_dicom_files(root):
+    """Return the DICOM files under root, relative to it and sorted.
+
+    Nested study trees are walked recursively. DICOMDIR index files are skipped,
+    since the instances they reference are found by the walk itself.
+    """
+    dicom_files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            if filename.upper() == DICOMDIR_NAME:
+                logger.info(f"Skipping DICOMDIR index: {full_path}")
+                continue
+            if is_dicom_file(full_path):
+                dicom_files.append(os.path.relpath(full_path, root))
+    return sorted(dicom_files)
+
+
+def resolve_input(path):
+    """Turn a directory or a DICOMDIR path into (directory, files relative to it)"""
+    if os.path.isdir(path):
+        return path, find_dicom_files(path)
+    if os.path.basename(path).upper() == DICOMDIR_NAME:
+        directory = os.path.dirname(os.path.abspath(path))
+        return directory, [f for f in dicomdir_files(path) if os.path.isfile(os.path.join(directory, f))]
+    return os.path.dirname(os.path.abspath(path)), [os.path.basename(path)]
@@ -1,224 +1,503 @@
-from fhirpy import SyncFHIRClient
+import asyncio
+import inspect
 import os
-import pydicom
-import base64
+import hashlib
 from dotenv import load_dotenv, find_dotenv
-from process import gender, extract_age, study_date, convert_dicom_to_image
+from process import gender, extract_age, study_date, convert_dicom_to_renditions, read_dataset, IMAGE_CONTENT_TYPES, RENDITION_FORMAT
+from manifest import Manifest
+from dead_letter import DeadLetterLog, DEAD_LETTER_PATH
+from retry import RetryingFHIRClient
+from fhirpy.base.exceptions import ResourceNotFound
+from fhirpy.base.utils import get_by_path
+import metrics
+from metrics import REGISTRY, METRICS_PATH
+from discovery import find_dicom_files
+from resource_cache import ResourceCache
+from streaming import Base64Payload
+from mapping import STUDY_FIELDS, SERIES_FIELDS, AGE_UNITS, extract, drop_empty, component, to_components, quantity
 
 # Set up the Azure authentication
 _ = load_dotenv(find_dotenv())
 
 FHIR_URL = os.environ["local_url"]
+# Set e.g. PNG, WEBP or JPEG2000 to store pixels once as a Binary instead of inline
+PIXEL_FORMAT = os.environ.get("pixel_format")
+# SQLite file recording pushed instances, so re-runs skip unchanged files
+MANIFEST_PATH = os.environ.get("manifest_path")
+# FHIR R4 ImagingStudy.series.instance has no frame count, so it is carried as an extension
+NUMBER_OF_FRAMES_URL = "urn:dicom:tag:00280008"
 
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def main(directory_path=None):
+def conversion_options(pixel_format=None, images=True):
+    """The options a file's resources depend on besides its content, kept with it in the manifest"""
+    return f"pixel_format={pixel_format}" if images else "images=False"
+
+def frame_binary_id(sop_instance_uid, number):
+    """Id of a frame's Binary; FHIR ids are at most 64 characters, which a long UID plus suffix can exceed"""
+    frame_id = f"{sop_instance_uid}-{number}"
+    if len(frame_id) > 64:
+        frame_id = f"{hashlib.sha1(sop_instance_uid.encode()).hexdigest()}-{number}"
+    return frame_id
+
+def build_resources(ds, pixel_format=None, images=True):
+    """Build the final-state FHIR resources for one DICOM dataset, in reference order.
+
+    By default the pixels are stored twice: raw PixelData in the series Observation and
+    an 8-bit windowed PNG Binary that DiagnosticReport.presentedForm points to. With
+    pixel_format (a key of IMAGE_CONTENT_TYPES) the stored values are encoded once,
+    losslessly at their own bit depth, into the Binary that both point to instead (PNG
+    when pixel_format cannot hold them). presentedForm also carries small inline 8-bit
+    "preview" and "thumbnail" renditions, so they can be read without the full image.
+    A multi-frame object is shown by its key frame. With pixel_format, which leaves no
+    raw PixelData, each of its frames is also stored as a Binary with a presentedForm
+    entry; these are only encoded as they are written out (see process.EncodedFrames).
+    With images=False no pixel data is touched, so ds may be read with
+    stop_before_pixels. Attributes are read once through mapping.extract; optional
+    ones that are missing or empty are left out of the resources.
+    """
+    values = extract(ds)
+    age_info = extract_age(values.get("PatientAge"))
+    study_started = study_date(values["StudyDate"]) if "StudyDate" in values else None
+
+    if not images:
+        binary_data = pixel_data = None
+        presented_forms = []
+    else:
+        if pixel_format:
+            renditions = convert_dicom_to_renditions(ds, format=pixel_format, lossless=True)
+        else:
+            renditions = convert_dicom_to_renditions(ds)
+        # The full image is a Binary of its own, so reading a report's renditions never pulls it
+        binary_data = {
+            "resourceType": "Binary",
+            "id": values["SOPInstanceUID"],
+            "contentType": IMAGE_CONTENT_TYPES[renditions["format"]],
+            "data": renditions["full"]
+        }
+        pixel_data = "Binary"+"/"+binary_data['id'] if pixel_format else Base64Payload(ds.PixelData)
+        presented_forms = [{"contentType": binary_data["contentType"], "url": "Binary"+"/"+binary_data['id'],
+                            "title": values["SOPClassUID"]}]
+        presented_forms += [
+            {"contentType": IMAGE_CONTENT_TYPES[RENDITION_FORMAT], "data": renditions[name], "title": name}
+            for name in ("preview", "thumbnail")
+        ]
+    frame_binaries = [{
+        "resourceType": "Binary",
+        "id": frame_binary_id(values["SOPInstanceUID"], number),
+        "contentType": IMAGE_CONTENT_TYPES[renditions["format"]],
+        "data": data
+    } for number, data in enumerate(renditions.get("frames", []) if images else [], 1)]
+    presented_forms += [
+        {"contentType": binary["contentType"], "url": "Binary/" + binary["id"], "title": f"frame-{number}"}
+        for number, binary in enumerate(frame_binaries, 1)
+    ]
+
+    # Patient resource
+    patient_data = {
+        "resourceType": "Patient",
+        "id": values["PatientID"],
+        "active": True,
+        # "birthDate": "1980-01-01",
+        "gender": gender(values.get("PatientSex")),
+        # "name": [{"family": "Smith", "given": ["John"]}]
+    }
+    if "age" in age_info:
+        patient_data["extension"] = [{
+            "url": "http://hl7.org/fhir/StructureDefinition/patient-age",
+            "valueAge": quantity(age_info["age"], AGE_UNITS.get(age_info["unit"]))
+        }]
+
+    # Device resource
+    device_data = {
+        "resourceType": "Device",
+        "id": values["SOPInstanceUID"],
+        "status": "inactive",
+        "identifier": [{"value": values["SOPClassUID"]}],
+        "manufacturer": values.get("Manufacturer"),
+        "modelNumber": values.get("ManufacturerModelName")
+    }
+
+    # ImagingStudy resource, holding this instance; ResourceCache merges the instances of a study
+    imaging_study_data = {
+        "resourceType": "ImagingStudy",
+        "id": values["StudyInstanceUID"],
+        "identifier": [{
+            "type": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v2-0203", "code": "ACSN"}]},
+            "value": values.get("AccessionNumber")
+        }],
+        "subject": {"reference": "Device"+"/"+device_data['id']},
+        "status": "available",
+        # "performer": [{"actor": {"reference": "Device"+"/"+device_data['id']}}],
+        "started": study_started,
+        "description": values.get("StudyDescription"),
+        "numberOfSeries": 1,
+        "numberOfInstances": 1,
+        "series": [
+            {
+                "uid": values["SeriesInstanceUID"],
+                "number": values.get("SeriesNumber"),
+                "modality": {
+                    "system": "http://dicom.nema.org/resources/ontology/DCM",
+                    "code": values.get("Modality")
+                    },
+                "description": values.get("StudyDescription"),
+                "bodySite": values.get("BodyPartExamined"),
+                "numberOfInstances": 1,
+                "instance": [
+                    {
+                        "uid": values["SOPInstanceUID"],
+                        "sopClass": {"system": "urn:ietf:rfc:3986", "code": "urn:oid:"+values["SOPClassUID"]},
+                        "number": values.get("InstanceNumber"),
+                        "extension": [{"url": NUMBER_OF_FRAMES_URL, "valueInteger": values["NumberOfFrames"]}]
+                        if "NumberOfFrames" in values else None
+                    }
+                ]
+            }
+        ]
+    }
+
+    # Study-level Observation resource
+    body_part_data = {
+        "resourceType": "Observation",
+        "id": values["StudyInstanceUID"],
+        "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "65737-9", "display": "Body part examined"}]},
+        "identifier": [{"value": values.get("StudyID")}],
+        "subject": {"reference": "Patient"+"/"+patient_data['id']},
+        "derivedFrom": [{"reference": "ImagingStudy"+"/"+imaging_study_data['id']}],
+        "component": to_components(values, STUDY_FIELDS)
+    }
+
+    # Series-level Observation resource
+    image_part_data = {
+        "resourceType": "Observation",
+        "id": values["SeriesInstanceUID"],
+        "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "65737-8", "display": "Body part examined"}]},
+        "identifier": [{"value": values.get("StudyID")}],
+        "subject": {"reference": "Patient"+"/"+patient_data['id']},
+        "derivedFrom": [{"reference": "Observation"+"/"+body_part_data['id']}],
+        "component": to_components(values, SERIES_FIELDS)
+    }
+    if pixel_data:
+        image_part_data["component"].append(component("pixeldata", "valueString", pixel_data))
+
+    # DiagnosticReport resource
+    diagnostic_report_data = {
+        "resourceType": "DiagnosticReport",
+        "id": values["SOPInstanceUID"],
+        "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "36642-7", "display": "Chest X-ray"}]},
+        "subject": {"reference": "Patient"+"/"+patient_data['id']},
+        "effectiveDateTime": study_started,
+        "imagingStudy": [{"reference": "ImagingStudy"+"/"+imaging_study_data['id']}],
+        # "basedOn": [{"reference": "ServiceRequest"+"/"+service_request_data['id']}],
+        "result": [{"reference": "Observation"+"/"+body_part_data['id']}, {"reference": "Observation"+"/"+image_part_data['id']}],
+    }
+    if presented_forms:
+        diagnostic_report_data["presentedForm"] = presented_forms
+
+    resources = [patient_data, device_data, imaging_study_data, body_part_data, image_part_data, diagnostic_report_data]
+    if binary_data:
+        resources[:0] = [binary_data] + frame_binaries
+    return [drop_empty(resource) for resource in resources]
+
+def save_resources(client, resources):
+    """Create or update each resource with a single PUT (see RetryingFHIRClient.put)"""
+    for resource in resources:
+        client.put(resource)
+
+def make_bundle(resources, bundle_type="transaction"):
+    """Wrap resources in a transaction/batch Bundle of PUTs keyed by Type/id.
+
+    Resources carry client-assigned ids, so each PUT is an idempotent create-or-update.
+    Entries sharing a Type/id (e.g. the Patient of every slice in a batch) collapse to
+    the last one, as a transaction may not touch the same resource twice.
+    """
+    entries = {}
+    for resource in resources:
+        url = f"{resource['resourceType']}/{resource['id']}"
+        entries[url] = {
+            "fullUrl": f"{FHIR_URL.rstrip('/')}/{url}",
+            "resource": resource,
+            "request": {"method": "PUT", "url": url}
+        }
+    return {"resourceType": "Bundle", "type": bundle_type, "entry": list(entries.values())}
+
+async def resolved(result):
+    """The result of a client call, awaited when the client is async (pipeline.PooledFHIRClient)"""
+    return await result if inspect.isawaitable(result) else result
+
+async def seed_studies(client, cache, resources):
+    """Without a manifest, start the aggregate of each new study from the ImagingStudy on the server"""
+    for key in cache.unseeded(resources):
+        try:
+            stored = await resolved(client.execute(key, method="get"))
+        except ResourceNotFound:
+            stored = None
+        cache.seed(key, stored)
+
+def failed_entries(bundle, response):
+    """{Type/id: reason} of the Bundle entries the response does not report as 2xx.
+
+    A batch is answered with 200 even when some of its entries failed, each entry of
+    the batch-response carrying its own status in request order. An entry the
+    response leaves out counts as failed.
+    """
+    results = (response or {}).get("entry") or []
+    failed = {}
+    for i, entry in enumerate(bundle["entry"]):
+        result = results[i].get("response") or {} if i < len(results) else {}
+        status = str(result.get("status") or "")
+        if not status.startswith("2"):
+            issue = get_by_path(result, ["outcome", "issue", 0]) or {}
+            failed[entry["request"]["url"]] = (f"HTTP {status or 'missing'}: "
+                                               f"{issue.get('diagnostics') or issue.get('code') or 'no details'}")
+    return failed
+
+def has_failed(resources, failed):
+    return any(f"{resource['resourceType']}/{resource['id']}" in failed for resource in resources)
+
+def bundle_saved(bundle, response, pending_files, cache, done):
+    """Book the files of a posted Bundle that its response confirms, and return the others.
+
+    pending_files are the (file, SOPInstanceUID, resources) the Bundle was made from.
+    Entries of a batch fail independently: the files owning a failed entry are
+    returned, to be saved again one at a time, and every other file is added to its
+    study aggregate and passed to done().
+    """
+    failed = failed_entries(bundle, response)
+    if failed:
+        logger.warning(f"{len(failed)} of {len(bundle['entry'])} Bundle entries failed "
+                       f"(first {': '.join(next(iter(failed.items())))}), saving their files one at a time")
+    saved, retried = [], []
+    for pending_file in pending_files:
+        (retried if has_failed(pending_file[2], failed) else saved).append(pending_file)
+    for _, _, file_resources in saved:
+        cache.added(file_resources)
+    cache.written([entry["resource"] for entry in bundle["entry"] if entry["request"]["url"] not in failed])
+    for dicom_file, sop_instance_uid, _ in saved:
+        done(dicom_file, sop_instance_uid)
+    return retried
+
+class ConversionRun:
+    """The state of one conversion, shared by main and pipeline.ingest.
+
+    Holds the manifest (none for in-memory sources), the ResourceCache and the
+    dead-letter log, the files processed so far and the SHA-256 digests already
+    computed for them, and writes the aggregated ImagingStudies at the end. Files
+    are recorded in the manifest with `options` (see conversion_options).
+    """
+
+    def __init__(self, directory_path, manifest_path=None, dead_letter_path=DEAD_LETTER_PATH, sources=None,
+                 options=""):
+        self.directory_path = directory_path
+        self.sources = sources
+        self.options = options
+        self.manifest = Manifest(manifest_path) if manifest_path and sources is None else None
+        self.cache = ResourceCache(self.manifest)
+        self.dead_letter = DeadLetterLog(dead_letter_path)
+        self.processed_files = []
+        self.digests = {}  # file: SHA-256 already computed by Manifest.check or a parse worker
+
+    def location(self, dicom_file):
+        """Where a file came from, for the logs, the manifest and the dead-letter file"""
+        return dicom_file if self.sources is not None else os.path.join(self.directory_path, dicom_file)
+
+    def done(self, dicom_file, sop_instance_uid):
+        if self.manifest:
+            try:
+                self.manifest.record(self.location(dicom_file), sop_instance_uid, self.digests.pop(dicom_file, None),
+                                     self.options)
+            except OSError as e:
+                # Its resources are saved; the file was only removed since (e.g. from a drop box)
+                logger.warning(f"Could not record {dicom_file} in the manifest: {e}")
+        self.processed_files.append(dicom_file)
+        REGISTRY.count("files_processed_total")
+        logger.info(f"Successfully processed {dicom_file}")
+
+    def saved(self, dicom_file, sop_instance_uid, file_resources):
+        """A file's resources are all on the server: add it to its study aggregate and record it"""
+        self.cache.added(file_resources)
+        self.done(dicom_file, sop_instance_uid)
+
+    async def write_studies(self, client, bundle_type=None):
+        """Write the aggregated ImagingStudies that changed, with a sync or async client.
+
+        A failed write is logged rather than raised: the files themselves are saved, and
+        a manifest keeps the aggregates for the next run.
+        """
+        studies = self.cache.stale_studies()
+        if not studies:
+            return
+        logger.info(f"Writing {len(studies)} aggregated ImagingStudy resources")
+        if bundle_type:
+            bundle = make_bundle(studies, bundle_type)
+            try:
+                failed = failed_entries(bundle, await resolved(client.execute("/", method="post", data=bundle)))
+            except Exception as e:
+                failed = {f"ImagingStudy/{study['id']}": str(e) for study in studies}
+        else:
+            async def write(study):
+                await resolved(client.put(study))
+            results = await asyncio.gather(*[write(study) for study in studies], return_exceptions=True)
+            failed = {f"ImagingStudy/{study['id']}": str(result)
+                      for study, result in zip(studies, results) if isinstance(result, Exception)}
+        if failed:
+            logger.error(f"Failed to write {len(failed)} aggregated ImagingStudy resources: "
+                         f"{next(iter(failed.values()))}")
+            REGISTRY.count("imaging_study_writes_failed_total", len(failed))
+            self.cache.unsaved([study for study in studies if has_failed([study], failed)])
+        self.cache.written([study for study in studies if not has_failed([study], failed)])
+
+    def close(self):
+        if self.dead_letter.count:
+            logger.warning(f"{self.dead_letter.count} files failed, see {self.dead_letter.path}")
+        if self.manifest:
+            self.manifest.close()
+
+async def main(directory_path=None, bundle_type=None, batch_size=1, concurrency=1, pixel_format=PIXEL_FORMAT,
+               manifest_path=MANIFEST_PATH, images=True, files=None, workers=None, dead_letter_path=DEAD_LETTER_PATH,
+               metrics_path=METRICS_PATH, output_dir=None, compression=None, sources=None):
+    """Convert every DICOM file under directory_path and push it to the FHIR server.
+
+    Nested directories are walked and files are recognised by extension or preamble;
+    pass files (paths relative to directory_path) to convert only those.
+
+    With bundle_type ("transaction" or "batch") the resources of batch_size files are
+    posted as one Bundle instead of one PUT per resource. With concurrency > 1 the
+    files are uploaded in parallel by pipeline.ingest and parsed by `workers`
+    processes. pixel_format and images are passed on to build_resources; with
+    images=False only the headers are read. With manifest_path, files already pushed
+    unchanged with the same pixel_format and images are skipped. A file that cannot be read or uploaded is logged to the
+    dead-letter JSONL at dead_letter_path and the run carries on; transient HTTP
+    failures are retried with backoff first. Timings and counters collected on the way
+    are logged at the end and written to metrics_path (see metrics.export).
+    Shared parents (Patient, ImagingStudy, study Observation) are only rewritten when
+    they change, and each study's aggregated ImagingStudy is written at the end.
+    With output_dir, nothing is sent to the server: the resources are written to
+    NDJSON files in output_dir instead (see bulk_export.export), compressed with
+    compression ("gzip", "zstd" or "none"; default ndjson_compression or gzip).
+    With sources ({name: file-like or bytes}, e.g. Streamlit uploads) the files are
+    converted straight from memory, each parsed once, and nothing is written to disk;
+    no manifest is kept for them.
+    """
     logger.info(f"Starting DICOM to FHIR conversion from directory: {directory_path}")
 
 # async def main():
 
     # Set up the FHIR client
-    client = SyncFHIRClient(
-        url=FHIR_URL, 
+    client = RetryingFHIRClient(
+        url=FHIR_URL,
         # authorization=f"Bearer {access_token}",
         extra_headers={"Content-Type": "application/fhir+json"})
-    
+
     # Use the provided directory_path instead of the script's directory
     search_path = directory_path if directory_path else os.path.dirname(os.path.abspath(__file__))
     logger.info(f"Searching for DICOM files in: {search_path}")
-    
-    processed_files = []  # Add this to track processed files
-    
-    for dicom_file in os.listdir(search_path):
-        if dicom_file.endswith(".dcm"):
-            full_path = os.path.join(search_path, dicom_file)
+
+    if sources is not None:
+        if output_dir:
+            raise ValueError("In-memory sources cannot be exported to NDJSON, pass a directory instead")
+        logger.info(f"Converting {len(sources)} in-memory files")
+        files = list(sources)
+        manifest_path = None
+
+    if output_dir:
+        import bulk_export
+        try:
+            return bulk_export.export(search_path, output_dir, files=files,
+                                      compression=compression or bulk_export.COMPRESSION, workers=workers,
+                                      batch_size=batch_size, pixel_format=pixel_format, images=images,
+                                      dead_letter_path=dead_letter_path)
+        finally:
+            metrics.export(metrics_path)
+
+    if concurrency > 1:
+        from pipeline import ingest
+        try:
+            return await ingest(search_path, concurrency=concurrency, bundle_type=bundle_type, batch_size=batch_size,
+                                workers=workers, pixel_format=pixel_format, manifest_path=manifest_path,
+                                images=images, files=files, dead_letter_path=dead_letter_path, sources=sources)
+        finally:
+            metrics.export(metrics_path)
+
+    run = ConversionRun(search_path, manifest_path, dead_letter_path, sources,
+                        conversion_options(pixel_format, images))
+    pending_files = []  # (file, SOPInstanceUID, resources) waiting for the next Bundle
+
+    async def upload(dicom_file, sop_instance_uid, file_resources):
+        try:
+            await seed_studies(client, run.cache, file_resources)
+            resources = run.cache.unwritten(file_resources)
+            save_resources(client, resources)
+        except Exception as e:
+            run.dead_letter.record(run.location(dicom_file), "upload", e)
+            return
+        run.cache.written(resources)
+        run.saved(dicom_file, sop_instance_uid, file_resources)
+
+    async def flush_bundle():
+        resources = [resource for _, _, file_resources in pending_files for resource in file_resources]
+        try:
+            await seed_studies(client, run.cache, resources)
+            resources = run.cache.unwritten(resources)
+            bundle = make_bundle(resources, bundle_type)
+            logger.info(f"Posting {bundle_type} bundle with {len(bundle['entry'])} entries for {len(pending_files)} files")
+            response = client.execute("/", method="post", data=bundle)
+        except Exception as e:
+            # One bad file fails the whole Bundle; save the files one at a time to isolate it
+            logger.warning(f"Bundle failed ({str(e)}), saving its {len(pending_files)} files one at a time")
+            retried = list(pending_files)
+        else:
+            retried = bundle_saved(bundle, response, pending_files, run.cache, run.done)
+        for dicom_file, sop_instance_uid, file_resources in retried:
+            await upload(dicom_file, sop_instance_uid, file_resources)
+        pending_files.clear()
+
+    if files is None:
+        files = find_dicom_files(search_path)
+
+    try:
+        for dicom_file in files:
+            full_path = run.location(dicom_file)
+            if run.manifest:
+                try:
+                    current, run.digests[dicom_file] = run.manifest.check(full_path, run.options)
+                except OSError:
+                    current = False  # read_dataset dead-letters it
+                if current:
+                    logger.info(f"Skipping unchanged file: {dicom_file}")
+                    continue
             logger.info(f"Processing file: {dicom_file}")
             try:
-                ds = pydicom.dcmread(full_path)
-
-                age_info = extract_age(ds.PatientAge)
-
-                # Convert MultiValue attributes to lists or strings
-                def convert_to_serializable(value):
-                    if isinstance(value, pydicom.multival.MultiValue):
-                        return list(value)  # Convert to list
-                    return value
-        
-                # Create or update a Patient resource
-                patient_data = client.resource(
-                    'Patient',
-                    id=ds.PatientID,
-                    active=False,
-                    # birthDate="1980-01-01",
-                    gender=gender(ds.PatientSex),
-                    extension=[{
-                        "url": "http://hl7.org/fhir/StructureDefinition/patient-age",
-                        "valueString": age_info["age"]
-                    }],
-                    # name=[{"family": "Smith", "given": ["John"]}]
-                )
-                patient_data.save()
-                print(patient_data.id)
-                
-                if patient_data['active'] is False:
-                    patient_data.active = True
-                patient_data.save()
-
-                # Create or update a device resource 
-                device_data = client.resource(
-                    'Device',
-                    id=ds.SOPInstanceUID,
-                    status="active",
-                    identifier=[{"value":ds.SOPClassUID}],
-                    manufacturer=ds.Manufacturer,
-                    modelNumber=ds.ManufacturerModelName
-                )
-                device_data.save()
-
-                if device_data['status'] == "active":
-                    device_data.status = "inactive"
-                device_data.save()
-
-                # Create or update an ImagingStudy resource
-                imaging_study_data = client.resource(
-                    'ImagingStudy',
-                    id=ds.StudyInstanceUID,
-                    subject={"reference": "Device"+"/"+device_data['id']},
-                    status="registered",
-                    # performer= [{"actor": {"reference": "Device"+"/"+device_data['id']}}],
-                    started=study_date(ds.StudyDate),
-                    # numberOfInstances=convert_to_serializable(ds.SeriesDescription),
-                    series=[
-                        {
-                            "uid": ds.SOPInstanceUID,
-                            "number": ds.AccessionNumber,
-                            "modality": {
-                                "system": "http://dicom.nema.org/resources/ontology/DCM",
-                                "code": ds.Modality
-                                },
-                            "description": convert_to_serializable(ds.StudyDescription),
-                            "bodySite": convert_to_serializable(ds.BodyPartExamined),
-                        }
-                    ]
-                )
-                imaging_study_data.save()
-
-                if imaging_study_data['status'] == "registered":
-                    imaging_study_data.status = "available"
-                imaging_study_data.save()
-
-                # Create or update an Observation resource
-                body_part_data = client.resource(
-                    'Observation',
-                    id=ds.StudyInstanceUID,
-                    status="registered",
-                    code={"coding": [{"system": "http://loinc.org", "code": "65737-9", "display": "Body part examined"}]},
-                    identifier=[{"value":ds.StudyID}],
-                    subject={"reference": "Patient"+"/"+patient_data['id']},
-                    derivedFrom=[{"reference": "ImagingStudy"+"/"+imaging_study_data['id']}],
-                    component=[
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"bodypartexamined"}]},"valueString": convert_to_serializable(ds.BodyPartExamined)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"scanoptions"}]},"valueString": convert_to_serializable(ds.ScanOptions)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"scanmode"}]},"valueString": convert_to_serializable(ds.SliceThickness)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"kvp"}]},"valueString": convert_to_serializable(ds.KVP)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"collectiondiameter"}]},"valueString": convert_to_serializable(ds.DataCollectionDiameter)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"protocolname"}]},"valueString": convert_to_serializable(ds.ProtocolName)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"reconstructiondiameter"}]},"valueString": convert_to_serializable(ds.ReconstructionDiameter)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"gantrydetectortilt"}]},"valueString": convert_to_serializable(ds.GantryDetectorTilt)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"tableheight"}]},"valueString": convert_to_serializable(ds.TableHeight)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"rotationdirection"}]},"valueString": convert_to_serializable(ds.RotationDirection)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"exposuretime"}]},"valueString": convert_to_serializable(ds.ExposureTime)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"xraytubecurrent"}]},"valueString": convert_to_serializable(ds.XRayTubeCurrent)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"exposure"}]},"valueString": convert_to_serializable(ds.Exposure)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"filtertype"}]},"valueString": convert_to_serializable(ds.FilterType)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"generatorpower"}]},"valueString": convert_to_serializable(ds.GeneratorPower)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"focalspot"}]},"valueString": convert_to_serializable(ds.FocalSpots)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"convolutionkernel"}]},"valueString": convert_to_serializable(ds.ConvolutionKernel)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"patientposition"}]},"valueString": convert_to_serializable(ds.PatientPosition)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"spiralpitchfactor"}]},"valueString": convert_to_serializable(ds.SpiralPitchFactor)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"ctdivol"}]},"valueString": convert_to_serializable(ds.CTDIvol)}
-                    ]
-                )
-                body_part_data.save()
-                
-                if body_part_data['status'] == "registered":
-                    body_part_data.status = "final"
-                body_part_data.save()
-
-                # Create or update an Observation resource
-                image_part_data = client.resource(
-                    'Observation',
-                    id=ds.SeriesInstanceUID,
-                    status="registered",
-                    code={"coding": [{"system": "http://loinc.org", "code": "65737-8", "display": "Body part examined"}]},
-                    identifier=[{"value":ds.StudyID}],
-                    subject={"reference": "Patient"+"/"+patient_data['id']},
-                    derivedFrom=[{"reference": "Observation"+"/"+body_part_data['id']}],
-                    component=[
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"seriesnumber"}]},"valueString": convert_to_serializable(ds.SeriesNumber)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"acquisitionnumber"}]},"valueString": convert_to_serializable(ds.AcquisitionNumber)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"instancenumber"}]},"valueString": convert_to_serializable(ds.InstanceNumber)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"patientorientation"}]},"valueString": convert_to_serializable(ds.PatientOrientation)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"imagepositionpatient"}]},"valueString": convert_to_serializable(ds.ImagePositionPatient)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"imageorientationpatient"}]},"valueString": convert_to_serializable(ds.ImageOrientationPatient)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"frameofreferenceuid"}]},"valueString": convert_to_serializable(ds.FrameOfReferenceUID)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"positionreferenceindicator"}]},"valueString": convert_to_serializable(ds.PositionReferenceIndicator)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"slicelocation"}]},"valueString": convert_to_serializable(ds.SliceLocation)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"samplesperpixel"}]},"valueString": convert_to_serializable(ds.SamplesPerPixel)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"photometricinterpretation"}]},"valueString": convert_to_serializable(ds.PhotometricInterpretation)},    
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"rows"}]},"valueString": convert_to_serializable(ds.Rows)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"columns"}]},"valueString": convert_to_serializable(ds.Columns)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"pixelspacing"}]},"valueString": convert_to_serializable(ds.PixelSpacing)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"bitsallocated"}]},"valueString": convert_to_serializable(ds.BitsAllocated)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"bitsstored"}]},"valueString": convert_to_serializable(ds.BitsStored)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"highbit"}]},"valueString": convert_to_serializable(ds.HighBit)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"pixelrepresentation"}]},"valueString": convert_to_serializable(ds.PixelRepresentation)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"windowcenter"}]},"valueString": convert_to_serializable(ds.WindowCenter)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"windowwidth"}]},"valueString": convert_to_serializable(ds.WindowWidth)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"rescaleintercept"}]},"valueString": convert_to_serializable(ds.RescaleIntercept)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"rescalevalue"}]},"valueString": convert_to_serializable(ds.RescaleSlope)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"performedproceduresstepid"}]},"valueString": convert_to_serializable(ds.PerformedProcedureStepID)},
-                        {"code":{"coding":[{"system":"http://loinc.org","code":"pixeldata"}]},"valueString": base64.b64encode(ds.PixelData).decode('utf-8')}
-                    ]
-                )
-                image_part_data.save()
-                
-                if image_part_data['status'] == "registered":
-                    image_part_data.status = "final"
-                image_part_data.save()
-
-                # Create or update a DiagnosticReport resource
-                diagnostic_report_data = client.resource(
-                    'DiagnosticReport',
-                    id=ds.SOPInstanceUID,
-                    status="registered",
-                    code={"coding": [{"system": "http://loinc.org", "code": "36642-7", "display": "Chest X-ray"}]},
-                    subject={"reference": "Patient"+"/"+patient_data['id']},
-                    effectiveDateTime=study_date(ds.StudyDate),
-                    imagingStudy=[{"reference": "ImagingStudy"+"/"+imaging_study_data['id']}],
-                    # basedOn=[{"reference": "ServiceRequest"+"/"+service_request_data['id']}],
-                    result=[{"reference": "Observation"+"/"+body_part_data['id']}, {"reference": "Observation"+"/"+image_part_data['id']}],
-                    presentedForm=[{"contentType": "image/png", "data": convert_dicom_to_image(ds),"title": ds.SOPClassUID}]
-                    )
-                diagnostic_report_data.save()
-
-                if diagnostic_report_data['status'] == 'registered':
-                    diagnostic_report_data.status = "final"
-                diagnostic_report_data.save()
-
-                processed_files.append(dicom_file)  # Add this to track successful processing
-            
-                logger.info(f"Successfully processed {dicom_file}")
+                ds = read_dataset(sources[dicom_file] if sources is not None else full_path, pixels=images)
+                with REGISTRY.timer("build_resources_seconds"):
+                    resources = build_resources(ds, pixel_format, images)
             except Exception as e:
-                logger.error(f"Error processing {dicom_file}: {str(e)}")
-                raise
-            
-    return processed_files
+                run.dead_letter.record(full_path, "parse", e)
+                continue
+
+            if bundle_type:
+                pending_files.append((dicom_file, ds.SOPInstanceUID, resources))
+                if len(pending_files) >= batch_size:
+                    await flush_bundle()
+            else:
+                await upload(dicom_file, ds.SOPInstanceUID, resources)
+
+        if pending_files:
+            await flush_bundle()
+        await run.write_studies(client, bundle_type)
+    finally:
+        run.close()
+        metrics.export(metrics_path)
+
+    return run.processed_files
 
 if __name__ == "__main__":
-    import asyncio
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
\ No newline at end of file
+    loop.run_until_complete(main())
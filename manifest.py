@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(full_path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """SQLite record of the DICOM instances already pushed to the FHIR server.
+
+    Rows are keyed by SOPInstanceUID and written as soon as a file's resources are
+    saved, so an interrupted run resumes where it stopped. A file is current when its
+    path, size and mtime match a row, or, failing that (a fresh copy, a re-upload),
+    when its size and SHA-256 do, and the row was converted with the same options
+    (main.conversion_options; None matches any). It also keeps the content hashes of written
+    resources for ResourceCache. A readonly manifest (e.g. opened in a parse worker)
+    can only be checked against.
+    """
+
+    def __init__(self, path, readonly=False):
+        if readonly:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS instances ("
+            "sop_instance_uid TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "mtime REAL NOT NULL, sha256 TEXT NOT NULL, pushed_at TEXT NOT NULL, options TEXT NOT NULL DEFAULT '')")
+        if "options" not in [column[1] for column in self.connection.execute("PRAGMA table_info(instances)")]:
+            # Manifests from before options were kept; their rows match no options, so they are converted again
+            self.connection.execute("ALTER TABLE instances ADD COLUMN options TEXT NOT NULL DEFAULT ''")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS instances_path ON instances (path)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS instances_sha256 ON instances (sha256)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS instances_size ON instances (size)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS resources (key TEXT PRIMARY KEY, sha256 TEXT NOT NULL, body TEXT)")
+        self.connection.commit()
+
+    def check(self, full_path, options=None):
+        """(current, sha256) of a file; sha256 is None unless it had to be computed.
+
+        The file is only hashed when its path, size and mtime match no row but some
+        row has the same size and options; pass the hash on to record() so it is not
+        read again.
+        """
+        stat = os.stat(full_path)
+        same_options = "" if options is None else " AND options = ?"
+        extra = () if options is None else (options,)
+        row = self.connection.execute(
+            "SELECT 1 FROM instances WHERE path = ? AND size = ? AND mtime = ?" + same_options,
+            (os.path.abspath(full_path), stat.st_size, stat.st_mtime) + extra).fetchone()
+        if row:
+            return True, None
+        if not self.connection.execute(
+                "SELECT 1 FROM instances WHERE size = ?" + same_options + " LIMIT 1", (stat.st_size,) + extra).fetchone():
+            return False, None
+        digest = file_hash(full_path)
+        row = self.connection.execute(
+            "SELECT 1 FROM instances WHERE sha256 = ? AND size = ?" + same_options,
+            (digest, stat.st_size) + extra).fetchone()
+        return row is not None, digest
+
+    def is_current(self, full_path, options=None):
+        return self.check(full_path, options)[0]
+
+    def record(self, full_path, sop_instance_uid, sha256=None, options=""):
+        stat = os.stat(full_path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO instances (sop_instance_uid, path, size, mtime, sha256, pushed_at, options) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (sop_instance_uid, os.path.abspath(full_path), stat.st_size, stat.st_mtime,
+             sha256 or file_hash(full_path), datetime.now(timezone.utc).isoformat(), options))
+        self.connection.commit()
+
+    def resource_hash(self, key):
+        row = self.connection.execute("SELECT sha256 FROM resources WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def resource_body(self, key):
+        row = self.connection.execute("SELECT body FROM resources WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def record_resource(self, key, sha256, body=None):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO resources VALUES (?, ?, ?)",
+            (key, sha256, json.dumps(body, default=str) if body is not None else None))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,254 @@
+from collections import namedtuple
+
+import pydicom
+from pydicom.datadict import tag_for_keyword
+
+LOINC_SYSTEM = "http://loinc.org"
+
+UCUM_SYSTEM = "http://unitsofmeasure.org"
+
+# One DICOM attribute stored as an Observation.component. kind is how the value is
+# typed: "decimal" (a valueQuantity in unit), "integer" (valueInteger), "string" or
+# "decimals" (a backslash-separated valueString, read back as a list of floats)
+Field = namedtuple("Field", ["tag", "keyword", "code", "column", "kind", "unit"])
+
+def compile_fields(rows):
+    """Resolve the tag number of each (keyword, code, column, kind, unit) row once"""
+    return tuple(Field(tag_for_keyword(keyword), keyword, code, column, kind, unit)
+                 for keyword, code, column, kind, unit in rows)
+
+
+# Study-level Observation (65737-9), in component order
+STUDY_FIELDS = compile_fields([
+    ("BodyPartExamined", "bodypartexamined", "body_part_examined", "string", None),
+    ("ScanOptions", "scanoptions", "scan_options", "string", None),
+    ("SliceThickness", "scanmode", "scan_mode", "decimal", "mm"),
+    ("KVP", "kvp", "kvp", "decimal", "kV"),
+    ("DataCollectionDiameter", "collectiondiameter", "collection_diameter", "decimal", "mm"),
+    ("ProtocolName", "protocolname", "protocol_name", "string", None),
+    ("ReconstructionDiameter", "reconstructiondiameter", "reconstruction_diameter", "decimal", "mm"),
+    ("GantryDetectorTilt", "gantrydetectortilt", "gantry_detector_tilt", "decimal", "deg"),
+    ("TableHeight", "tableheight", "table_height", "decimal", "mm"),
+    ("RotationDirection", "rotationdirection", "rotation_direction", "string", None),
+    ("ExposureTime", "exposuretime", "exposure_time", "decimal", "ms"),
+    ("XRayTubeCurrent", "xraytubecurrent", "xray_tube_current", "decimal", "mA"),
+    ("Exposure", "exposure", "exposure", "decimal", "mA.s"),
+    ("FilterType", "filtertype", "filter_type", "string", None),
+    ("GeneratorPower", "generatorpower", "generator_power", "decimal", "kW"),
+    ("FocalSpots", "focalspot", "focal_spots", "decimals", None),
+    ("ConvolutionKernel", "convolutionkernel", "convolution_kernel", "string", None),
+    ("PatientPosition", "patientposition", "patient_position", "string", None),
+    ("SpiralPitchFactor", "spiralpitchfactor", "spiral_pitch_factor", "decimal", "1"),
+    ("CTDIvol", "ctdivol", "ctdi_vol", "decimal", "mGy"),
+])
+
+# Series-level Observation (65737-8), in component order
+SERIES_FIELDS = compile_fields([
+    ("SeriesNumber", "seriesnumber", "seriesnumber", "integer", None),
+    ("AcquisitionNumber", "acquisitionnumber", "acquisitionnumber", "integer", None),
+    ("InstanceNumber", "instancenumber", "instancenumber", "integer", None),
+    ("PatientOrientation", "patientorientation", "patientorientation", "string", None),
+    ("ImagePositionPatient", "imagepositionpatient", "imagepositionpatient", "decimals", None),
+    ("ImageOrientationPatient", "imageorientationpatient", "imageorientationpatient", "decimals", None),
+    ("FrameOfReferenceUID", "frameofreferenceuid", "frameofreferenceuid", "string", None),
+    ("PositionReferenceIndicator", "positionreferenceindicator", "positionreferenceindicator", "string", None),
+    ("SliceLocation", "slicelocation", "slicelocation", "decimal", "mm"),
+    ("SamplesPerPixel", "samplesperpixel", "samplesperpixel", "integer", None),
+    ("PhotometricInterpretation", "photometricinterpretation", "photometricinterpretation", "string", None),
+    ("Rows", "rows", "rows", "integer", None),
+    ("Columns", "columns", "columns", "integer", None),
+    ("PixelSpacing", "pixelspacing", "pixelspacing", "decimals", None),
+    ("BitsAllocated", "bitsallocated", "bitsallocated", "integer", None),
+    ("BitsStored", "bitsstored", "bitsstored", "integer", None),
+    ("HighBit", "highbit", "highbit", "integer", None),
+    ("PixelRepresentation", "pixelrepresentation", "pixelrepresentation", "integer", None),
+    ("NumberOfFrames", "numberofframes", "numberofframes", "integer", None),
+    ("WindowCenter", "windowcenter", "windowcenter", "decimals", None),
+    ("WindowWidth", "windowwidth", "windowwidth", "decimals", None),
+    ("RescaleIntercept", "rescaleintercept", "rescaleintercept", "decimal", None),
+    ("RescaleSlope", "rescalevalue", "rescalevalue", "decimal", None),
+    ("PerformedProcedureStepID", "performedproceduresstepid", "performedproceduresstepid", "string", None),
+])
+
+STUDY_FIELDS_BY_CODE = {field.code: field for field in STUDY_FIELDS}
+SERIES_FIELDS_BY_CODE = {field.code: field for field in SERIES_FIELDS}
+
+
+# UCUM codes of the age units process.extract_age returns
+AGE_UNITS = {"years": "a", "months": "mo", "weeks": "wk", "days": "d"}
+
+# Attributes build_resources reads outside the Observation components
+INSTANCE_KEYWORDS = (
+    "SOPInstanceUID", "SOPClassUID", "StudyInstanceUID", "SeriesInstanceUID", "PatientID", "PatientSex",
+    "PatientAge", "StudyDate", "StudyID", "StudyDescription", "AccessionNumber", "Modality", "SeriesNumber",
+    "InstanceNumber", "BodyPartExamined", "Manufacturer", "ManufacturerModelName",
+)
+# Without these the resource ids and references cannot be built
+REQUIRED_KEYWORDS = ("SOPInstanceUID", "SOPClassUID", "StudyInstanceUID", "SeriesInstanceUID", "PatientID")
+
+# Every tag extract() looks for, resolved once: {tag: keyword}
+EXTRACT_TAGS = {tag_for_keyword(keyword): keyword for keyword in INSTANCE_KEYWORDS}
+EXTRACT_TAGS.update((field.tag, field.keyword) for field in STUDY_FIELDS + SERIES_FIELDS)
+
+
+def json_value(value):
+    """Convert a DICOM element value to a native JSON type, or None if it has none"""
+    if isinstance(value, (pydicom.sequence.Sequence, bytes)):
+        return None
+    if isinstance(value, (pydicom.multival.MultiValue, list, tuple)):
+        values = [json_value(item) for item in value]
+        return values if any(item is not None for item in values) else None
+    if isinstance(value, pydicom.valuerep.PersonName):
+        value = str(value)
+    elif isinstance(value, (float, pydicom.valuerep.DSdecimal)):  # DS, FD, FL
+        return float(value)
+    elif isinstance(value, int):  # IS, US, UL...
+        return int(value)
+    if isinstance(value, str):
+        value = str(value).strip()
+    return value if value not in ("", None) else None
+
+
+# Where enhanced multi-frame objects keep per-frame attributes such as PixelSpacing or WindowCenter
+FUNCTIONAL_GROUPS = ("PerFrameFunctionalGroupsSequence", "SharedFunctionalGroupsSequence")
+
+
+def functional_group_elements(ds):
+    """{tag: element} of the functional group macros of an enhanced multi-frame object.
+
+    Shared groups take precedence over the groups of the first frame. Empty for
+    datasets without functional groups.
+    """
+    elements = {}
+    for keyword in FUNCTIONAL_GROUPS:
+        groups = ds.get(keyword)
+        if not groups:
+            continue
+        for macro in groups[0]:
+            if macro.VR == "SQ" and macro.value:
+                elements.update((element.tag, element) for element in macro.value[0])
+    return elements
+
+
+def functional_value(ds, keyword):
+    """keyword's value in ds, else in its functional groups, else None"""
+    value = ds.get(keyword)
+    if value is None and any(group in ds for group in FUNCTIONAL_GROUPS):
+        element = functional_group_elements(ds).get(tag_for_keyword(keyword))
+        value = element.value if element is not None else None
+    return value
+
+
+def extract(ds):
+    """Read every needed attribute of ds in one pass: {keyword: JSON value}.
+
+    Only tags present in the dataset are converted (so a deferred PixelData is never
+    loaded), and missing or empty attributes are left out. Attributes an enhanced
+    multi-frame object keeps in its functional groups are read from there. Raises
+    ValueError when one of REQUIRED_KEYWORDS is missing.
+    """
+    values = {}
+    for tag in EXTRACT_TAGS.keys() & ds.keys():
+        value = json_value(ds[tag].value)
+        if value is not None:
+            values[EXTRACT_TAGS[tag]] = value
+    if any(group in ds for group in FUNCTIONAL_GROUPS):
+        for tag, element in functional_group_elements(ds).items():
+            keyword = EXTRACT_TAGS.get(tag)
+            if keyword and keyword not in values:
+                value = json_value(element.value)
+                if value is not None:
+                    values[keyword] = value
+    missing = [keyword for keyword in REQUIRED_KEYWORDS if keyword not in values]
+    if missing:
+        raise ValueError(f"Missing required DICOM attributes: {', '.join(missing)}")
+    return values
+
+
+def drop_empty(value):
+    """Recursively remove None, empty strings, lists and dicts, which FHIR does not allow"""
+    if isinstance(value, dict):
+        value = {key: drop_empty(item) for key, item in value.items()}
+        return {key: item for key, item in value.items() if item not in (None, "", [], {})}
+    if isinstance(value, list):
+        return [item for item in map(drop_empty, value) if item not in (None, "", [], {})]
+    return value
+
+
+def component(code, value_type, value):
+    return {"code": {"coding": [{"system": LOINC_SYSTEM, "code": code}]}, value_type: value}
+
+
+def quantity(value, unit=None):
+    result = {"value": value}
+    if unit:
+        result.update(unit=unit, system=UCUM_SYSTEM, code=unit)
+    return result
+
+
+def field_value(field, value):
+    """The (value type, value) a field's extracted JSON value is stored as.
+
+    Values that do not parse as the field's kind are kept as a valueString.
+    """
+    first = value[0] if isinstance(value, list) else value
+    try:
+        if field.kind == "integer":
+            return "valueInteger", int(first)
+        if field.kind == "decimal":
+            return "valueQuantity", quantity(float(first), field.unit)
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, list):
+        return "valueString", "\\".join("" if item is None else str(item) for item in value)
+    return "valueString", str(value)
+
+
+def to_components(values, fields):
+    """Serialize the extracted fields into Observation components, skipping absent ones"""
+    return [component(field.code, *field_value(field, values[field.keyword]))
+            for field in fields if field.keyword in values]
+
+
+def parse_number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_value(field, item):
+    """The typed value of a component, whichever value[x] it was stored as.
+
+    Observations written before the components were typed hold every value as a
+    valueString (multi-valued ones as "a\\b" or "[a, b]"); those are parsed too.
+    """
+    if "valueQuantity" in item:
+        value = item["valueQuantity"].get("value")
+    elif "valueInteger" in item:
+        value = item["valueInteger"]
+    else:
+        value = item.get("valueString")
+    if value is None or field.kind == "string":
+        return value
+    if isinstance(value, str):
+        parts = [part.strip() for part in value.strip("[]").replace(",", "\\").split("\\")]
+        value = parts if field.kind == "decimals" else parts[0]
+    if field.kind == "decimals":
+        values = [parse_number(item, float) for item in (value if isinstance(value, list) else [value])]
+        return values if any(item is not None for item in values) else None
+    if field.kind == "integer":
+        number = parse_number(value, float)
+        return int(number) if number is not None and number.is_integer() else None
+    return parse_number(value, float)
+
+
+def from_components(observation, fields_by_code):
+    """Flatten Observation components into {column: typed value}, matching them by code"""
+    record = dict.fromkeys(field.column for field in fields_by_code.values())
+    for item in observation.get("component", []):
+        codings = item.get("code", {}).get("coding") or [{}]
+        field = fields_by_code.get(codings[0].get("code"))
+        if field:
+            record[field.column] = read_value(field, item)
+    return record
@@ -0,0 +1,181 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Written at the end of each conversion: JSON for a .json path, Prometheus text otherwise
+METRICS_PATH = os.environ.get("metrics_path")
+PROMETHEUS_PREFIX = "dicom_fhir_"
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    """Process-wide counters and timers, keyed by name and labels.
+
+    Timers keep a count, total and maximum of their observations. Worker processes
+    collect into their own registry and ship a snapshot() back for merge().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.timers = {}
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters), dict(self.timers)
+
+    def merge(self, snapshot):
+        counters, timers = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+            for key, (count, total, longest) in timers.items():
+                current = self.timers.get(key, (0, 0.0, 0.0))
+                self.timers[key] = (current[0] + count, current[1] + total, max(current[2], longest))
+
+    def since(self, snapshot):
+        """A registry of what was recorded after snapshot() returned `snapshot`, e.g. by one run.
+
+        A timer's maximum cannot be split by time, so a timer that moved keeps its overall max.
+        """
+        counters, timers = self.snapshot()
+        counters_before, timers_before = snapshot
+        delta = Metrics()
+        for key, value in counters.items():
+            if value != counters_before.get(key, 0):
+                delta.counters[key] = value - counters_before.get(key, 0)
+        for key, (count, total, longest) in timers.items():
+            before = timers_before.get(key, (0, 0.0, 0.0))
+            if count != before[0]:
+                delta.timers[key] = (count - before[0], total - before[1], longest)
+        return delta
+
+    def as_dict(self):
+        counters, timers = self.snapshot()
+        result = {"counters": defaultdict(list), "timers": defaultdict(list)}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"][name].append({"labels": dict(labels), "value": value})
+        for (name, labels), (count, total, longest) in sorted(timers.items()):
+            result["timers"][name].append({"labels": dict(labels), "count": count, "seconds": total,
+                                           "mean": total / count, "max": longest})
+        return {kind: dict(values) for kind, values in result.items()}
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format; timers are summaries"""
+        counters, timers = self.snapshot()
+        lines = []
+
+        def series(name, labels, value):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"{PROMETHEUS_PREFIX}{name}{{{label_text}}} {value}" if labels
+                         else f"{PROMETHEUS_PREFIX}{name} {value}")
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    series(name, labels, value)
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} summary")
+            for (timer_name, labels), (count, total, _) in sorted(timers.items()):
+                if timer_name == name:
+                    series(f"{name}_count", labels, count)
+                    series(f"{name}_sum", labels, total)
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_max gauge")
+            for (timer_name, labels), (_, _, longest) in sorted(timers.items()):
+                if timer_name == name:
+                    series(f"{name}_max", labels, longest)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, "w") as f:
+            if path.endswith(".json"):
+                json.dump(self.as_dict(), f, indent=2)
+            else:
+                f.write(self.prometheus())
+
+    def log_summary(self, limit=10):
+        """Log the timers with the largest total time"""
+        _, timers = self.snapshot()
+        for (name, labels), (count, total, longest) in sorted(
+                timers.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+            label_text = ",".join(f"{key}={value}" for key, value in labels)
+            logger.info(f"{name}{{{label_text}}}: {count} calls, {total:.3f}s total, "
+                        f"{1000 * total / count:.1f}ms mean, {1000 * longest:.1f}ms max")
+
+
+REGISTRY = Metrics()
+
+
+def export(path=METRICS_PATH):
+    """Log the slowest stages and, with a path, write the metrics out"""
+    REGISTRY.log_summary()
+    if path:
+        REGISTRY.write(path)
+        logger.info(f"Metrics written to {path}")
+
+
+@contextmanager
+def profiled(path):
+    """Profile the block into path: a pyinstrument HTML report for .html, else cProfile stats.
+
+    Only the current process is profiled, not the parse workers of pipeline.ingest.
+    """
+    if not path:
+        yield
+        return
+    if path.endswith(".html"):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed, writing cProfile stats instead")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(path, "w") as f:
+                    f.write(profiler.output_html())
+            return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
@@ -0,0 +1,256 @@
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+REJECTED = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing"}]}
+
+# Search parameters usable in _include, mapped to the element holding the reference
+INCLUDE_ELEMENTS = {"subject": "subject", "result": "result", "derived-from": "derivedFrom"}
+
+
+def subset(resource, elements):
+    """resource reduced to the top-level elements listed in an _elements parameter"""
+    keep = set(",".join(elements).split(",")) | {"resourceType", "id", "meta"}
+    return {name: value for name, value in resource.items() if name in keep}
+
+
+def references(resource, element):
+    value = resource.get(element)
+    for item in value if isinstance(value, list) else [value] if value else []:
+        if item.get("reference"):
+            yield "/".join(item["reference"].split("/")[-2:])
+
+
+class MockFHIRServer:
+    """In-process stand-in for the HAPI server, for benchmarks and local runs.
+
+    Supports what the converter uses: PUT Type/id (raw content for a Binary),
+    transaction/batch Bundles of PUTs, GET Type/id and searches by _id, status, code
+    and _lastUpdated with _include, _include:iterate, _sort=-_lastUpdated, _elements and paging. With bulk_export, a system-level
+    $export (_type, _since) is answered by an async job that reports "in progress"
+    once before serving its NDJSON files. Every request waits `latency` seconds
+    (plus up to `jitter`), and fails with a 503 at `error_rate`. Resources for which
+    `reject(resource)` is true are refused with a 422: as the PUT's status, as their
+    entry's status in a batch, or for the whole of a transaction.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, port=0, bulk_export=True, reject=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bulk_export = bulk_export
+        self.reject = reject or (lambda resource: False)
+        self.resources = {}
+        self.export_jobs = {}  # job id: [polls so far, {resource type: NDJSON bytes}]
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/fhir"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def put(self, resource_type, resource_id, resource):
+        resource = dict(resource, id=resource_id, meta={"lastUpdated": datetime.now(timezone.utc).isoformat()})
+        with self.lock:
+            self.resources[f"{resource_type}/{resource_id}"] = resource
+        return resource
+
+    def search(self, resource_type, query):
+        matches = [resource for key, resource in list(self.resources.items()) if key.startswith(resource_type + "/")]
+        if "_id" in query:
+            ids = set(",".join(query["_id"]).split(","))
+            matches = [resource for resource in matches if resource["id"] in ids]
+        if "status" in query:
+            matches = [resource for resource in matches if resource.get("status") == query["status"][0]]
+        if "code" in query:
+            code = query["code"][0].split("|")[-1]
+            matches = [resource for resource in matches
+                       if any(coding.get("code") == code for coding in resource.get("code", {}).get("coding", []))]
+        if "_lastUpdated" in query:
+            since = query["_lastUpdated"][0][2:]
+            matches = [resource for resource in matches if resource["meta"]["lastUpdated"] > since]
+        if query.get("_sort") == ["-_lastUpdated"]:
+            matches.sort(key=lambda resource: resource["meta"]["lastUpdated"], reverse=True)
+        return matches
+
+    def start_export(self, query):
+        types = ",".join(query.get("_type", [])).split(",") if "_type" in query else None
+        since = query.get("_since", [""])[0]
+        files = {}
+        for key, resource in list(self.resources.items()):
+            resource_type = key.split("/")[0]
+            if (types is None or resource_type in types) and resource["meta"]["lastUpdated"] > since:
+                files.setdefault(resource_type, []).append(json.dumps(resource))
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.export_jobs[job_id] = [0, {resource_type: ("\n".join(lines) + "\n").encode()
+                                            for resource_type, lines in files.items()}]
+        return job_id
+
+    def include(self, matches, query):
+        """Resources pulled in by _include and _include:iterate"""
+        included = {}
+        found = {f"{resource['resourceType']}/{resource['id']}" for resource in matches}
+        pending = list(matches)
+        rounds = [query.get("_include", [])] + [query.get("_include:iterate", [])] * 3
+        for includes in rounds:
+            added = []
+            for include in includes:
+                source_type, parameter = include.split(":")[:2]
+                for resource in pending + list(included.values()):
+                    if resource["resourceType"] != source_type:
+                        continue
+                    for key in references(resource, INCLUDE_ELEMENTS.get(parameter, parameter)):
+                        if key not in found and key in self.resources:
+                            found.add(key)
+                            included[key] = self.resources[key]
+                            added.append(self.resources[key])
+            pending = added
+        return list(included.values())
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=None, headers=None, content_type="application/fhir+json"):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def export(self, parts, query):
+                """$export kick-off, status polls ($export-poll/job) and files ($export-file/job/Type)"""
+                if parts[0] == "$export":
+                    if not server.bulk_export:
+                        return self.send(404, {"resourceType": "OperationOutcome",
+                                               "issue": [{"severity": "error", "code": "not-supported"}]})
+                    job_id = server.start_export(query)
+                    return self.send(202, headers={"Content-Location": f"{server.url}/$export-poll/{job_id}"})
+                job = server.export_jobs.get(parts[1])
+                if job is None:
+                    return self.send(404, {"resourceType": "OperationOutcome"})
+                if parts[0] == "$export-file":
+                    return self.send(200, job[1].get(parts[2], b""), content_type="application/fhir+ndjson")
+                job[0] += 1
+                if job[0] == 1:
+                    return self.send(202, headers={"X-Progress": "in progress", "Retry-After": "0"})
+                return self.send(200, {
+                    "transactionTime": datetime.now(timezone.utc).isoformat(),
+                    "request": self.path,
+                    "requiresAccessToken": False,
+                    "output": [{"type": resource_type, "url": f"{server.url}/$export-file/{parts[1]}/{resource_type}"}
+                               for resource_type in job[1]],
+                    "error": [],
+                })
+
+            def read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                data = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if data and "json" not in content_type:
+                    # A raw Binary, stored as FHIR would return it
+                    return {"resourceType": "Binary", "contentType": content_type,
+                            "data": base64.b64encode(data).decode()}
+                return json.loads(data) if data else None
+
+            def begin(self):
+                """Count the request and apply the injected latency and failures; False if it failed"""
+                with server.lock:
+                    server.request_count += 1
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+                if random.random() < server.error_rate:
+                    self.read_body()
+                    self.send(503, {"resourceType": "OperationOutcome",
+                                    "issue": [{"severity": "error", "code": "transient"}]})
+                    return False
+                return True
+
+            def parts(self):
+                return [part for part in urlparse(self.path).path.split("/") if part and part != "fhir"]
+
+            def do_DELETE(self):
+                if not self.begin():
+                    return
+                parts = self.parts()
+                server.export_jobs.pop(parts[-1], None)
+                self.send(202)
+
+            def do_PUT(self):
+                if not self.begin():
+                    return
+                resource_type, resource_id = self.parts()[-2:]
+                resource = self.read_body()
+                if server.reject(resource):
+                    return self.send(422, REJECTED)
+                resource = server.put(resource_type, resource_id, resource)
+                self.send(200, None if self.headers.get("Prefer") == "return=minimal" else resource)
+
+            def do_POST(self):
+                if not self.begin():
+                    return
+                bundle = self.read_body()
+                if bundle["type"] == "transaction" and any(server.reject(entry["resource"])
+                                                           for entry in bundle.get("entry", [])):
+                    return self.send(400, REJECTED)
+                entries = []
+                for entry in bundle.get("entry", []):
+                    if server.reject(entry["resource"]):
+                        entries.append({"response": {"status": "422 Unprocessable Entity", "outcome": REJECTED}})
+                        continue
+                    resource_type, resource_id = entry["request"]["url"].split("/")[-2:]
+                    server.put(resource_type, resource_id, entry["resource"])
+                    entries.append({"response": {"status": "200 OK", "location": entry["request"]["url"]}})
+                self.send(200, {"resourceType": "Bundle", "type": f"{bundle['type']}-response", "entry": entries})
+
+            def do_GET(self):
+                if not self.begin():
+                    return
+                parts = self.parts()
+                query = parse_qs(urlparse(self.path).query)
+                if parts[0].startswith("$export"):
+                    return self.export(parts, query)
+                if len(parts) == 2:
+                    resource = server.resources.get("/".join(parts))
+                    return self.send(200, resource) if resource else self.send(404, {"resourceType": "OperationOutcome"})
+                matches = server.search(parts[0], query)
+                count = int(query.get("_count", [len(matches) or 1])[0])
+                offset = int(query.get("_offset", [0])[0])
+                page = matches[offset:offset + count]
+                entries = [{"resource": subset(resource, query["_elements"]) if "_elements" in query else resource,
+                            "search": {"mode": "match"}} for resource in page]
+                entries += [{"resource": resource, "search": {"mode": "include"}}
+                            for resource in server.include(page, query)]
+                links = []
+                if offset + count < len(matches):
+                    next_query = dict(query, _offset=[str(offset + count)])
+                    links.append({"relation": "next",
+                                  "url": f"{server.url}/{parts[0]}?{urlencode(next_query, doseq=True)}"})
+                self.send(200, {"resourceType": "Bundle", "type": "searchset", "total": len(matches),
+                                "link": links, "entry": entries})
+
+        return Handler
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import aiohttp
+from fhirpy import AsyncFHIRClient
+from fhirpy.base.exceptions import OperationOutcome, ResourceNotFound
+from fhirpy.base.utils import AttrDict
+
+from main import FHIR_URL, ConversionRun, conversion_options, build_resources, make_bundle, bundle_saved, seed_studies
+from process import read_dataset
+from manifest import Manifest, file_hash
+from discovery import find_dicom_files
+from metrics import REGISTRY
+from dead_letter import DEAD_LETTER_PATH
+from streaming import JSONStream, raw_binary
+from retry import (PUT_HEADERS, RETRY_ATTEMPTS, RETRY_STATUSES, REQUEST_TIMEOUT, TransientHTTPError,
+                   async_call_with_retry, request_labels, retry_after)
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = int(os.environ.get("fhir_concurrency", 8))
+KEEPALIVE_TIMEOUT = 30
+
+
+class PooledFHIRClient(AsyncFHIRClient):
+    """AsyncFHIRClient whose requests all go through one keep-alive aiohttp session.
+
+    fhirpy opens a fresh ClientSession for every request; here a single TCPConnector
+    is shared instead, capped at `concurrency` connections in total and `per_host`
+    connections to the FHIR server. Requests beyond the cap wait for a free
+    connection, which is what throttles the uploads. Timeouts, dropped connections,
+    429 and 5xx responses are retried with backoff, as every write is an idempotent PUT.
+    Bodies are streamed through JSONStream, like RetryingFHIRClient's.
+    """
+
+    def __init__(self, url, concurrency=CONCURRENCY, per_host=None, attempts=RETRY_ATTEMPTS, **kwargs):
+        super().__init__(url, **kwargs)
+        self.attempts = attempts
+        self.connector_config = {
+            "limit": concurrency,
+            "limit_per_host": per_host or concurrency,
+            "keepalive_timeout": KEEPALIVE_TIMEOUT,
+        }
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(**self.connector_config),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            headers=self._build_request_headers())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def put(self, resource):
+        """Create or update resource by id, as RetryingFHIRClient.put does"""
+        path = f"{resource['resourceType']}/{resource['id']}"
+        # A frame Binary is only encoded when its data is read, so that happens off the event loop
+        raw = await asyncio.to_thread(raw_binary, resource)
+        if raw:
+            return await self._do_request("put", path, data=raw[0],
+                                          extra_headers={**PUT_HEADERS, "Content-Type": raw[1]})
+        return await self._do_request("put", path, data=resource, extra_headers=PUT_HEADERS)
+
+    async def _do_request(self, method, path, *args, **kwargs):
+        with REGISTRY.timer("fhir_request_seconds", **request_labels(method, path)):
+            return await async_call_with_retry(self._request_once, method, path, *args, attempts=self.attempts,
+                                               **kwargs)
+
+    async def _request_once(self, method, path, data=None, params=None, extra_headers=None, *, returning_status=False):
+        url = self._build_request_url(path, params)
+        # Serialised here rather than by aiohttp, so the body is streamed and its bytes counted
+        headers = dict(extra_headers or {})
+        body, length = data, len(data or b"")
+        if data is not None and not isinstance(data, bytes):
+            stream = JSONStream(data)
+            body, length = stream.aiter(), len(stream)
+            headers["Content-Length"] = str(length)
+        async with self.session.request(method, url, data=body, headers=headers, **self.aiohttp_config) as r:
+            raw = await r.read()
+            raw_data = raw.decode()
+            REGISTRY.count("fhir_responses_total", status=r.status)
+            REGISTRY.count("fhir_bytes_sent_total", length)
+            REGISTRY.count("fhir_bytes_received_total", len(raw))
+            if 200 <= r.status < 300:
+                r_data = json.loads(raw_data, object_hook=AttrDict) if raw_data else None
+                return (r_data, r.status) if returning_status else r_data
+            if r.status in RETRY_STATUSES:
+                raise TransientHTTPError(r.status, raw_data, retry_after(r.headers))
+            if r.status in (404, 410):
+                raise ResourceNotFound(raw_data)
+            raise OperationOutcome(reason=f"HTTP {r.status}: {raw_data}")
+
+
+def read_resources(source, pixel_format=None, images=True):
+    """Parse one DICOM file (or in-memory buffer) and return its SOPInstanceUID and FHIR resources"""
+    ds = read_dataset(source, pixels=images)
+    with REGISTRY.timer("build_resources_seconds"):
+        return ds.SOPInstanceUID, build_resources(ds, pixel_format, images)
+
+
+def parse_batch(sources, pixel_format=None, images=True):
+    """Parse a batch of files or buffers into (uid, resources, error) triples.
+
+    A file that fails to parse gets (None, None, error) so the rest of its batch goes on.
+    """
+    results = []
+    for source in sources:
+        try:
+            results.append((*read_resources(source, pixel_format, images), None))
+        except Exception as e:
+            results.append((None, None, e))
+    return results
+
+
+# Read-only manifest connections of this (worker) process, by path
+WORKER_MANIFESTS = {}
+
+
+def worker_manifest(path):
+    if path not in WORKER_MANIFESTS:
+        WORKER_MANIFESTS[path] = Manifest(path, readonly=True)
+    return WORKER_MANIFESTS[path]
+
+
+def read_batch(full_paths, pixel_format=None, images=True, manifest_path=None, options=None):
+    """Process-pool stage: parse_batch in a worker, returning the batch's metrics for the parent to merge.
+
+    With manifest_path, files the manifest holds unchanged, converted with the same
+    options, are not parsed and get (None, None, None); the SHA-256 of every other
+    parsed file is computed here, off the upload loop, and returned as a third value
+    for Manifest.record.
+    """
+    REGISTRY.reset()
+    if not manifest_path:
+        return parse_batch(full_paths, pixel_format, images), REGISTRY.snapshot(), [None] * len(full_paths)
+    manifest = worker_manifest(manifest_path)
+    digests = [None] * len(full_paths)
+    changed = []
+    for i, full_path in enumerate(full_paths):
+        try:
+            current, digests[i] = manifest.check(full_path, options)
+        except OSError:
+            current = False  # parse_batch reports it
+        if not current:
+            changed.append(i)
+    results = [(None, None, None)] * len(full_paths)
+    for i, result in zip(changed, parse_batch([full_paths[i] for i in changed], pixel_format, images)):
+        results[i] = result
+        if result[2] is None and digests[i] is None:
+            digests[i] = file_hash(full_paths[i])
+    return results, REGISTRY.snapshot(), digests
+
+
+async def ingest(directory_path, concurrency=CONCURRENCY, per_host=None, bundle_type=None, batch_size=1,
+                 workers=None, queue_size=None, pixel_format=None, manifest_path=None, images=True, files=None,
+                 dead_letter_path=DEAD_LETTER_PATH, sources=None):
+    """Convert the DICOM files under directory_path (or `files`, relative to it) with a two-stage pipeline.
+
+    A process pool of `workers` parses files and builds their resources (dcmread, pixel
+    encoding and base64 are CPU-bound), handing batches to `concurrency` upload
+    coroutines through a queue of at most `queue_size` batches. Resources of one file
+    are saved in reference order; with bundle_type each batch goes up as one Bundle.
+    With manifest_path, files already pushed unchanged are skipped and each upload is
+    recorded as soon as it succeeds. Unchanged shared parents are skipped through a
+    ResourceCache and the aggregated ImagingStudies are written last. Files that fail to
+    parse or upload go to the dead-letter JSONL without stopping the others.
+
+    With sources ({name: file-like or bytes}) the in-memory files are converted instead.
+    They are parsed by a pool of `workers` threads rather than processes, so the
+    buffers are never copied to another process, and no manifest is kept. Without a
+    manifest, each study's aggregate starts from the ImagingStudy on the server.
+    """
+    if sources is not None:
+        files = list(sources)
+        manifest_path = None
+    run = ConversionRun(directory_path, manifest_path, dead_letter_path, sources,
+                        conversion_options(pixel_format, images))
+    cache = run.cache
+    location = run.location
+
+    # Unchanged files are skipped by the parse workers, which check them against the manifest
+    dicom_files = files if files is not None else find_dicom_files(directory_path)
+    batches = [dicom_files[i:i + batch_size] for i in range(0, len(dicom_files), batch_size)]
+    workers = workers or os.cpu_count()
+    queue_size = queue_size or 2 * concurrency
+    logger.info(f"Converting {len(dicom_files)} files in {len(batches)} batches with "
+                f"{workers} parse workers and concurrency {concurrency}")
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    # A slot is held until the parsed batch is queued, so at most workers + queue_size batches sit in memory
+    parse_slots = asyncio.Semaphore(workers)
+    # Slices of one study share their Patient/ImagingStudy; never write the same one twice at once
+    resource_locks = defaultdict(asyncio.Lock)
+
+    async def parse(pool, batch):
+        try:
+            logger.info(f"Processing files: {batch}")
+            if sources is not None:
+                # Threads share this process's registry, so there is nothing to merge
+                resources = await loop.run_in_executor(
+                    pool, parse_batch, [sources[f] for f in batch], pixel_format, images)
+            else:
+                resources, worker_metrics, batch_digests = await loop.run_in_executor(
+                    pool, read_batch, [location(f) for f in batch], pixel_format, images, manifest_path, run.options)
+                REGISTRY.merge(worker_metrics)
+                run.digests.update(zip(batch, batch_digests))
+        except Exception as e:
+            # The batch as a whole failed (e.g. a worker process died); dead-letter its files, not the run
+            resources = [(None, None, e)] * len(batch)
+        try:
+            await queue.put((batch, resources))
+        finally:
+            parse_slots.release()
+
+    async def produce(pool):
+        parse_tasks = []
+        for batch in batches:
+            await parse_slots.acquire()
+            parse_tasks.append(asyncio.ensure_future(parse(pool, batch)))
+        try:
+            await asyncio.gather(*parse_tasks)
+        finally:
+            for task in parse_tasks:
+                task.cancel()
+            await asyncio.gather(*parse_tasks, return_exceptions=True)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def save(client, resource):
+        async with resource_locks[(resource["resourceType"], resource["id"])]:
+            await seed_studies(client, cache, [resource])
+            # Waiting on the lock means another file may just have written the same content
+            if not cache.unwritten([resource]):
+                return
+            await client.put(resource)
+            cache.written([resource])
+
+    async def upload_file(client, dicom_file, sop_instance_uid, file_resources):
+        try:
+            for resource in file_resources:
+                await save(client, resource)
+        except Exception as e:
+            run.dead_letter.record(location(dicom_file), "upload", e)
+            return
+        run.saved(dicom_file, sop_instance_uid, file_resources)
+
+    async def upload(client):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            batch, batch_results = item
+            parsed = []
+            for dicom_file, (sop_instance_uid, file_resources, error) in zip(batch, batch_results):
+                if error:
+                    run.dead_letter.record(location(dicom_file), "parse", error)
+                elif file_resources is None:
+                    logger.info(f"Skipping unchanged file: {dicom_file}")
+                else:
+                    parsed.append((dicom_file, sop_instance_uid, file_resources))
+            if bundle_type and parsed:
+                resources = [resource for _, _, file_resources in parsed for resource in file_resources]
+                try:
+                    await seed_studies(client, cache, resources)
+                    resources = cache.unwritten(resources)
+                    bundle = make_bundle(resources, bundle_type)
+                    response = await client.execute("/", method="post", data=bundle)
+                except Exception as e:
+                    # One bad file fails the whole Bundle; save the files one at a time to isolate it
+                    logger.warning(f"Bundle failed ({str(e)}), saving its {len(parsed)} files one at a time")
+                else:
+                    parsed = bundle_saved(bundle, response, parsed, cache, run.done)
+            for dicom_file, sop_instance_uid, file_resources in parsed:
+                await upload_file(client, dicom_file, sop_instance_uid, file_resources)
+
+    executor = ThreadPoolExecutor if sources is not None else ProcessPoolExecutor
+    with executor(max_workers=workers) as pool:
+        async with PooledFHIRClient(
+                url=FHIR_URL,
+                concurrency=concurrency,
+                per_host=per_host,
+                extra_headers={"Content-Type": "application/fhir+json"}) as client:
+            tasks = [asyncio.ensure_future(produce(pool))]
+            tasks += [asyncio.ensure_future(upload(client)) for _ in range(concurrency)]
+            try:
+                await asyncio.gather(*tasks)
+                await run.write_studies(client, bundle_type)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                run.close()
+
+    return run.processed_files
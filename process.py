@@ -1,3 +1,4 @@
+import hashlib
 import matplotlib.pyplot as plt
 import pydicom
 import os
@@ -45,20 +46,259 @@ def extract_age(age_code):
 
 # print(f"Extracted Age: {age_info['age']} {age_info['unit']}")
 
-import base64
 from io import BytesIO
+import numpy as np
 from PIL import Image
+from record_cache import RecordCache
+from metrics import REGISTRY
+from streaming import Base64Payload
+from mapping import functional_value
+from pydicom.pixels import get_decoder
 
-def convert_dicom_to_image(dicom_file, format="TIFF"):
-    pixel_array = dicom_file.pixel_array
-    image = Image.fromarray(pixel_array)
-    buffer = BytesIO()
-    image.save(buffer, format=format)
-    image_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return image_string
+# Elements larger than this (in practice PixelData) are only read from disk when accessed
+DEFER_SIZE = "256 KB"
+
+def read_dataset(source, pixels=True):
+    """Read a DICOM file, file-like object or in-memory bytes.
+
+    Without pixels the read stops before PixelData. Otherwise large elements are
+    deferred, so the pixel bytes are only loaded if a rendition actually uses them;
+    deferred elements of a file-like object are read from it, so it must stay open.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        REGISTRY.count("dicom_read_bytes_total", os.path.getsize(source))
+    else:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        # An upload may already have been read once, e.g. on a Streamlit rerun
+        source.seek(0)
+        REGISTRY.count("dicom_read_bytes_total", source.getbuffer().nbytes if hasattr(source, "getbuffer") else 0)
+    with REGISTRY.timer("dicom_read_seconds", pixels=pixels):
+        if not pixels:
+            return pydicom.dcmread(source, stop_before_pixels=True)
+        return pydicom.dcmread(source, defer_size=DEFER_SIZE)
+
+# Content types of the images convert_dicom_to_renditions can produce
+IMAGE_CONTENT_TYPES = {
+    "TIFF": "image/tiff",
+    "PNG": "image/png",
+    "JPEG2000": "image/jp2",
+    "WEBP": "image/webp",
+}
+
+# (center, width) window presets, in Hounsfield units
+WINDOW_PRESETS = {
+    "brain": (40, 80),
+    "soft_tissue": (40, 400),
+    "bone": (400, 1800),
+    "lung": (-600, 1500),
+}
+# Preset used for renditions; unset uses the file's own WindowCenter/WindowWidth
+WINDOW_PRESET = os.environ.get("window_preset")
+
+def first_value(value):
+    if isinstance(value, pydicom.multival.MultiValue):
+        return float(value[0])
+    return float(value)
+
+def rescale(dicom_file):
+    """(slope, intercept) of the stored values, from the dataset or its functional groups"""
+    return (first_value(functional_value(dicom_file, "RescaleSlope") or 1),
+            first_value(functional_value(dicom_file, "RescaleIntercept") or 0))
+
+def render_pixels(dicom_file, window=None, pixels=None):
+    """Rescale and window stored pixels into a uint8 array for display.
+
+    Applies RescaleSlope/Intercept, then the `window` preset (or a (center, width)
+    pair), the file's WindowCenter/WindowWidth or the full pixel range, all in place
+    on one float32 copy. `pixels` may be a stack of frames (frames, rows, columns); it
+    defaults to the whole pixel_array. Colour images are returned as they are.
+    """
+    pixels = dicom_file.pixel_array if pixels is None else pixels
+    if dicom_file.get("SamplesPerPixel", 1) != 1:
+        return pixels
+
+    pixels = pixels.astype(np.float32)
+    slope, intercept = rescale(dicom_file)
+    if slope != 1:
+        pixels *= slope
+    if intercept:
+        pixels += intercept
+
+    file_center, file_width = functional_value(dicom_file, "WindowCenter"), functional_value(dicom_file, "WindowWidth")
+    if isinstance(window, tuple):
+        center, width = window
+    elif window:
+        center, width = WINDOW_PRESETS[window]
+    elif file_center is not None and file_width is not None:
+        center, width = first_value(file_center), first_value(file_width)
+    else:
+        low, high = float(pixels.min()), float(pixels.max())
+        center, width = (low + high) / 2, high - low
+
+    pixels -= center - width / 2
+    pixels *= 255.0 / max(width, 1)
+    np.clip(pixels, 0, 255, out=pixels)
+    rendered = pixels.astype(np.uint8)
+    if dicom_file.get("PhotometricInterpretation") == "MONOCHROME1":
+        np.subtract(255, rendered, out=rendered)
+    return rendered
+
+# Frames of a multi-frame object decoded and rendered together
+FRAME_BATCH = int(os.environ.get("frame_batch", 16))
+
+def number_of_frames(dicom_file):
+    return int(dicom_file.get("NumberOfFrames") or 1)
+
+def iter_frames(dicom_file, indices=None, batch_size=FRAME_BATCH):
+    """Decode the frames at `indices` (default: all) batch_size at a time.
+
+    Yields (indices, stack) pairs, stack being a (frames, rows, columns[, samples])
+    array, so no more than one batch of a multi-frame object is decoded at once.
+    """
+    decoder = get_decoder(dicom_file.file_meta.TransferSyntaxUID)
+    indices = list(range(number_of_frames(dicom_file)) if indices is None else indices)
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start:start + batch_size]
+        with REGISTRY.timer("decode_seconds"):
+            frames = [frame for frame, _ in decoder.iter_array(dicom_file, indices=batch)]
+        yield batch, np.stack(frames)
+
+def encode_image(image, format, **options):
+    """Encode image in format, as a Base64Payload that is only base64-encoded when written out"""
+    with REGISTRY.timer("encode_seconds", format=format):
+        buffer = BytesIO()
+        image.save(buffer, format=format, **options)
+        return Base64Payload(buffer.getvalue())
+
+# Formats that hold each PIL mode of stored values losslessly; WEBP has no 16-bit grey
+LOSSLESS_FORMATS = {
+    "L": ("PNG", "TIFF", "JPEG2000", "WEBP"),
+    "RGB": ("PNG", "TIFF", "JPEG2000", "WEBP"),
+    "I;16": ("PNG", "TIFF", "JPEG2000"),
+}
+# Encoder options that make a format lossless; PNG and TIFF always are, as is PIL's default JPEG2000
+LOSSLESS_OPTIONS = {"WEBP": {"lossless": True}}
+
+def stored_image(pixels):
+    """PIL image of stored pixel values, bit for bit: 8 or 16-bit grey, or 8-bit colour.
+
+    Signed values keep their two's-complement bits; PixelRepresentation, RescaleSlope
+    and RescaleIntercept say how to read them.
+    """
+    if pixels.ndim == 2 and pixels.dtype.itemsize in (1, 2):
+        return Image.fromarray(pixels.view(f"u{pixels.dtype.itemsize}"))
+    if pixels.ndim == 3 and pixels.dtype == np.uint8:
+        return Image.fromarray(pixels)
+    raise ValueError(f"Cannot store {pixels.dtype} pixels of shape {pixels.shape} losslessly")
+
+def lossless_format(image, format):
+    """format if it holds image's mode losslessly, else PNG"""
+    return format if format in LOSSLESS_FORMATS[image.mode] else "PNG"
+
+def key_frame(dicom_file):
+    """Stored values of the image, or of the key (middle) frame of a multi-frame object, which is then the only one decoded"""
+    frames = number_of_frames(dicom_file)
+    if frames == 1:
+        return dicom_file.pixel_array
+    _, stack = next(iter_frames(dicom_file, [frames // 2]))
+    return stack[0]
+
+def render_key_frame(dicom_file, window=None, pixels=None):
+    """Render the image, or the key (middle) frame of a multi-frame object, from `pixels` if key_frame already decoded it"""
+    pixels = key_frame(dicom_file) if pixels is None else pixels
+    with REGISTRY.timer("render_seconds"):
+        return render_pixels(dicom_file, window, pixels)
+
+# Longest side, in pixels, of the downscaled renditions made for the image viewer
+PREVIEW_SIZE = 512
+THUMBNAIL_SIZE = 128
+RENDITION_FORMAT = "WEBP"
+
+class EncodedFrames:
+    """The frames of a multi-frame object, encoded losslessly in `format` only as they are read.
+
+    Iterating gives one FramePayload per frame. A frame's batch of frame_batch frames is
+    decoded and encoded when one of them is first read, and only the batch last read
+    is kept. Pickled (e.g. by a parse worker) it carries the file's path instead of its
+    pixels, and the frames are read from the file again where they are written out.
+    """
+
+    def __init__(self, source, format, digest=None, count=None):
+        self.source = source  # the dataset, or the path to read it from
+        self.format = format
+        # Frames stand for the stored pixels they are encoded from in content hashes
+        self.digest = digest or f"sha256:{hashlib.sha256(source.PixelData).hexdigest()}:{format}"
+        self.count = count or number_of_frames(source)
+        self.batch = {}
+
+    def __reduce__(self):
+        filename = getattr(self.source, "filename", None)
+        return EncodedFrames, (filename if isinstance(filename, str) else self.source, self.format, self.digest,
+                               self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (FramePayload(self, index) for index in range(self.count))
+
+    def encoded(self, index):
+        if index not in self.batch:
+            if not isinstance(self.source, pydicom.Dataset):
+                self.source = read_dataset(self.source)
+            self.batch = {}  # drop the previous batch before decoding the next
+            start = index - index % FRAME_BATCH
+            indices, stack = next(iter_frames(self.source, range(start, min(start + FRAME_BATCH, self.count))))
+            self.batch = {i: encode_image(stored_image(frame), self.format, **LOSSLESS_OPTIONS.get(self.format, {})).data
+                          for i, frame in zip(indices, stack)}
+        return self.batch[index]
+
+
+class FramePayload(Base64Payload):
+    """One frame of EncodedFrames, encoded when its bytes are first read"""
+
+    def __init__(self, frames, index):
+        self.frames = frames
+        self.index = index
+        self._digest = f"{frames.digest}:{index}"
+
+    def __reduce__(self):
+        return FramePayload, (self.frames, self.index)
+
+    @property
+    def data(self):
+        return self.frames.encoded(self.index)
+
+
+def convert_dicom_to_renditions(dicom_file, format="PNG", window=WINDOW_PRESET, lossless=False):
+    """Render the pixels once and encode the full image, a preview and a thumbnail.
+
+    Of a multi-frame object only the key (middle) frame is decoded for these. The
+    preview and thumbnail are always windowed to 8 bits. The full image is too, unless
+    lossless: it then holds the stored values at their own bit depth, in format if
+    that can hold them losslessly and else in PNG; "format" names the one used, and
+    the frames of a multi-frame object are also kept as "frames", EncodedFrames in
+    that format.
+    """
+    pixels = key_frame(dicom_file)
+    image = Image.fromarray(render_key_frame(dicom_file, window, pixels))
+    if lossless:
+        stored = stored_image(pixels)
+        format = lossless_format(stored, format)
+        renditions = {"full": encode_image(stored, format, **LOSSLESS_OPTIONS.get(format, {}))}
+        if number_of_frames(dicom_file) > 1:
+            renditions["frames"] = EncodedFrames(dicom_file, format)
+    else:
+        renditions = {"full": encode_image(image, format)}
+    renditions["format"] = format
+    for name, size in (("preview", PREVIEW_SIZE), ("thumbnail", THUMBNAIL_SIZE)):
+        image.thumbnail((size, size))  # shrinks in place, keeping the aspect ratio
+        renditions[name] = encode_image(image, RENDITION_FORMAT)
+    return renditions
 
 # Add the dicomConverter directory to Python path
-converter_path = "/Users/ethelschinedu/corhorApp/dicomConverter"
+converter_path = os.environ.get("converter_path", os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(converter_path)
 
 # Import the main and query modules
@@ -71,130 +311,36 @@ def import_module(module_name, module_path):
 main_module = import_module("main", os.path.join(converter_path, "main.py"))
 query_module = import_module("query", os.path.join(converter_path, "query.py"))
 
-def get_fhir_data():
-    """Fetch FHIR data without saving to CSV"""
-    import asyncio
-    
-    async def fetch_data():
-        client = query_module.SyncFHIRClient(
-            url=query_module.FHIR_URL,
-            extra_headers={"Content-Type": "application/fhir+json"}
-        )
-        
-        all_records = []
-        reports = client.resources('DiagnosticReport').fetch_all()
-        
-        for report in reports:
-            if report['status'] == 'final' and report['code']['coding'][0]['code'] == '36642-7':
-                record = {
-                    'recorded_date': report.get('effectiveDateTime'),
-                    'image_title': report.get_by_path('presentedForm.0.title'),
-                    'sopinstanceUID': report.get('id'),
-                    'image_data': report.get_by_path('presentedForm.0.data'),  # Add image data
-                    'patient_id': None,
-                    'gender': None,
-                    'age': None
-                }
-                
-                # Add patient data
-                patient_data = report.get_by_path('subject.reference')
-                if patient_data and '/' in patient_data:
-                    patient_id = patient_data.split('/')[1]
-                    record['patient_id'] = patient_id
-                    patients = client.resources('Patient').search(_id=patient_id).fetch_all()
-                    for patient in patients:
-                        record['gender'] = patient.get('gender')
-                        record['age'] = patient.get_by_path("extension.0.valueString")
-                
-                for observation in report.get('result', []):
-                    reference = observation.get('reference')
-                    if reference:
-                        obs_id = reference.split('/')[1]
-                        body_paths = client.resources('Observation').search(_id=obs_id).fetch_all()
-                        for body_path in body_paths:
-                            code = body_path.get_by_path('code.coding.0.code')
-                            if code == '65737-9':
-                                # Add study-related fields
-                                record.update({
-                                    'studyinstanceuid': body_path.get('id'),
-                                    'study_id': body_path.get_by_path('identifier.0.value'),
-                                    'body_part_examined': body_path.get_by_path('component.0.valueString'),
-                                    'scan_options': body_path.get_by_path('component.1.valueString'),
-                                    'scan_mode': body_path.get_by_path('component.2.valueString'),
-                                    'kvp': body_path.get_by_path('component.3.valueString'),
-                                    'collection_diameter': body_path.get_by_path('component.4.valueString'),
-                                    'protocol_name': body_path.get_by_path('component.5.valueString'),
-                                    'reconstruction_diameter': body_path.get_by_path('component.6.valueString'),
-                                    'gantry_detector_tilt': body_path.get_by_path('component.7.valueString'),
-                                    'table_height': body_path.get_by_path('component.8.valueString'),
-                                    'rotation_direction': body_path.get_by_path('component.9.valueString'),
-                                    'exposure_time': body_path.get_by_path('component.10.valueString'),
-                                    'xray_tube_current': body_path.get_by_path('component.11.valueString'),
-                                    'exposure': body_path.get_by_path('component.12.valueString'),
-                                    'filter_type': body_path.get_by_path('component.13.valueString'),
-                                    'generator_power': body_path.get_by_path('component.14.valueString'),
-                                    'focal_spots': body_path.get_by_path('component.15.valueString'),
-                                    'convolution_kernel': body_path.get_by_path('component.16.valueString'),
-                                    'patient_position': body_path.get_by_path('component.17.valueString'),
-                                    'spiral_pitch_factor': body_path.get_by_path('component.18.valueString'),
-                                    'ctdi_vol': body_path.get_by_path('component.19.valueString')
-                                })
-
-                                # Add imaging study data
-                                imaging_data = body_path.get_by_path('derivedFrom.0.reference')
-                                if imaging_data is not None and '/' in patient_data:
-                                    image_id = imaging_data.split('/')[1]
-                                    images = client.resources('ImagingStudy').search(_id=image_id).fetch_all()
-                                    for image in images:
-                                        record.update({
-                                            'accession_number': image.get_by_path('series.0.number'),
-                                            'modality': image.get_by_path('series.0.modality.code'),
-                                            'study_description': image.get_by_path('series.0.description')
-                                        })
-
-                                        # Add device data
-                                        device_data = image.get_by_path('subject.reference')
-                                        if device_data is not None and '/' in device_data:
-                                            device_id = device_data.split('/')[1]
-                                            devices = client.resources('Device').search(_id=device_id).fetch_all()
-                                            for device in devices:
-                                                record.update({
-                                                    'manufacturer': device.get('manufacturer'),
-                                                    'model_number': device.get('modelNumber')
-                                                })
-
-                            if code == '65737-8':
-                                # Add series-related fields
-                                record.update({
-                                    'seriesinstanceuid': body_path.get('id'),
-                                    'seriesnumber': body_path.get_by_path('component.0.valueString'),
-                                    'acquisitionnumber': body_path.get_by_path('component.1.valueString'),
-                                    'instancenumber': body_path.get_by_path('component.2.valueString'),
-                                    'patientorientation': body_path.get_by_path('component.3.valueString'),
-                                    'imagepositionpatient': body_path.get_by_path('component.4.valueString'),
-                                    'imageorientationpatient': body_path.get_by_path('component.5.valueString'),
-                                    'frameofreferenceuid': body_path.get_by_path('component.6.valueString'),
-                                    'positionreferenceindicator': body_path.get_by_path('component.7.valueString'),
-                                    'slicelocation': body_path.get_by_path('component.8.valueString'),
-                                    'samplesperpixel': body_path.get_by_path('component.9.valueString'),
-                                    'photometricinterpretation': body_path.get_by_path('component.10.valueString'),
-                                    'rows': body_path.get_by_path('component.11.valueString'),
-                                    'columns': body_path.get_by_path('component.12.valueString'),
-                                    'pixelspacing': body_path.get_by_path('component.13.valueString'),
-                                    'bitsallocated': body_path.get_by_path('component.14.valueString'),
-                                    'bitsstored': body_path.get_by_path('component.15.valueString'),
-                                    'highbit': body_path.get_by_path('component.16.valueString'),
-                                    'pixelrepresentation': body_path.get_by_path('component.17.valueString'),
-                                    'windowcenter': body_path.get_by_path('component.18.valueString'),
-                                    'windowwidth': body_path.get_by_path('component.19.valueString'),
-                                    'rescaleintercept': body_path.get_by_path('component.20.valueString'),
-                                    'rescalevalue': body_path.get_by_path('component.21.valueString'),
-                                    'performedproceduresstepid': body_path.get_by_path('component.22.valueString'),
-                                    # 'pixeldata': body_path.get_by_path('component.23.valueString')
-                                })
-                
-                all_records.append(record)
-        
-        return all_records
-    
-    return asyncio.run(fetch_data())
\ No newline at end of file
+def fetch_image(image_url):
+    """Fetch the base64 data of a Binary rendition referenced by presentedForm.url"""
+    client = query_module.RetryingFHIRClient(
+        url=query_module.FHIR_URL,
+        extra_headers={"Content-Type": "application/fhir+json"}
+    )
+    return client.execute(image_url, method="get").get('data')
+
+def fetch_image_columns(report_ids):
+    """Fetch the image columns (full image, renditions) of records listed with get_fhir_data(images=False)"""
+    client = query_module.RetryingFHIRClient(
+        url=query_module.FHIR_URL,
+        extra_headers={"Content-Type": "application/fhir+json"}
+    )
+    return query_module.fetch_image_columns(client, list(report_ids))
+
+# Records already read from the server, shared by every Streamlit session of this process
+record_cache = RecordCache(os.environ.get("record_cache_path"), ttl=int(os.environ.get("record_cache_ttl", 60)))
+
+def get_fhir_data(images=True):
+    """Fetch FHIR data without saving to CSV, through the record cache"""
+    client = query_module.RetryingFHIRClient(
+        url=query_module.FHIR_URL,
+        extra_headers={"Content-Type": "application/fhir+json"}
+    )
+    return record_cache.get(
+        f"{query_module.FHIR_URL}|DiagnosticReport|images={images}",
+        lambda: query_module.latest_update(client),
+        lambda since: query_module.iter_records(client, images=images, since=since))
+
+def invalidate_fhir_data():
+    """Make the next get_fhir_data() pick up resources written since it last checked"""
+    record_cache.invalidate()
@@ -1,139 +1,462 @@
-from fhirpy import SyncFHIRClient
+from retry import RetryingFHIRClient, REQUEST_TIMEOUT, TRANSIENT_ERRORS, call_with_retry, raise_for_transient, retry_after
+from metrics import REGISTRY
+from fhirpy.base.utils import get_by_path
+from collections import defaultdict
+from mapping import STUDY_FIELDS, SERIES_FIELDS, STUDY_FIELDS_BY_CODE, SERIES_FIELDS_BY_CODE, from_components
+import csv
+import datetime
+import gzip
+import json
+import logging
 import os
+import shutil
+import tempfile
+import time
+import requests
 from dotenv import load_dotenv, find_dotenv
-import pandas as pd  # Add pandas import
 
 # Set up the Azure authentication
 _ = load_dotenv(find_dotenv())
 
 FHIR_URL = os.environ["local_url"]
 
-async def main():
+logger = logging.getLogger(__name__)
+
+REPORT_CODE = '36642-7'
+STUDY_OBSERVATION_CODE = '65737-9'
+SERIES_OBSERVATION_CODE = '65737-8'
+# Reports per search page, and ids per `_id=a,b,c` fallback search
+PAGE_SIZE = 100
+ID_BATCH_SIZE = 100
+
+# Pull every resource a report row needs along with the reports themselves
+REPORT_SEARCH_PARAMS = {
+    'status': 'final',
+    'code': f'http://loinc.org|{REPORT_CODE}',
+    '_include': ['DiagnosticReport:subject', 'DiagnosticReport:result'],
+    '_include:iterate': ['Observation:derived-from', 'ImagingStudy:subject'],
+}
+# Report elements needed for a metadata-only pull; leaves out presentedForm and its image data
+REPORT_ELEMENTS = ['status', 'code', 'subject', 'effectiveDateTime', 'imagingStudy', 'result']
+
+# Resource types read through the Bulk Data $export operation; reports are joined last
+EXPORT_TYPES = ['Patient', 'Device', 'ImagingStudy', 'Observation', 'DiagnosticReport']
+# Seconds between status polls when the server sends no Retry-After, and before giving up on a job
+EXPORT_POLL_INTERVAL = 2.0
+EXPORT_TIMEOUT = float(os.environ.get('bulk_export_timeout', 3600))
+
+# Export columns, in the order the records are built
+RECORD_COLUMNS = [
+    'recorded_date', 'sopinstanceUID', 'image_data', 'image_url', 'image_content_type', 'image_title',
+    'preview_data', 'thumbnail_data',
+    'patient_id', 'gender', 'age', 'studyinstanceuid', 'study_id', *(field.column for field in STUDY_FIELDS),
+    'accession_number', 'modality', 'study_description', 'manufacturer', 'model_number',
+    'seriesinstanceuid', *(field.column for field in SERIES_FIELDS),
+]
+# Base64 image payloads, left out of metadata-only exports
+IMAGE_COLUMNS = ['image_data', 'preview_data', 'thumbnail_data']
+
+def reference_key(reference):
+    """Normalise a (possibly absolute) reference to 'Type/id'"""
+    if reference and '/' in reference:
+        return '/'.join(reference.split('/')[-2:])
+    return None
+
+def iter_bundles(client, resource_type, params):
+    """Yield each page of a search as a raw Bundle, following next links"""
+    bundle = client.execute(resource_type, method='get', params=params)
+    while bundle:
+        yield bundle
+        next_link = get_by_path(bundle, ['link', {'relation': 'next'}, 'url'])
+        bundle = client.execute(next_link, method='get') if next_link else None
+
+def index_bundle(index, bundle):
+    """Add every resource of a Bundle to index under 'Type/id'"""
+    for entry in bundle.get('entry', []):
+        resource = entry['resource']
+        index[f"{resource['resourceType']}/{resource['id']}"] = resource
+
+def resolve_references(client, index, references):
+    """Fetch referenced resources missing from index with batched _id searches.
+
+    Only needed when the server ignored some of the _include parameters.
+    """
+    missing = defaultdict(set)
+    for reference in references:
+        key = reference_key(reference)
+        if key and key not in index:
+            resource_type, resource_id = key.split('/')
+            missing[resource_type].add(resource_id)
+    for resource_type, ids in missing.items():
+        ids = sorted(ids)
+        for i in range(0, len(ids), ID_BATCH_SIZE):
+            params = {'_id': ','.join(ids[i:i + ID_BATCH_SIZE]), '_count': ID_BATCH_SIZE}
+            for bundle in iter_bundles(client, resource_type, params):
+                index_bundle(index, bundle)
+
+def resolve_page(client, index, reports):
+    """Make sure index holds the Patient, Observations, ImagingStudy and Device of each report"""
+    resolve_references(client, index, [get_by_path(report, ['subject', 'reference']) for report in reports] +
+                       [result.get('reference') for report in reports for result in report.get('result', [])])
+    observations = [index[key] for key in list(index) if key.startswith('Observation/')]
+    resolve_references(client, index, [get_by_path(obs, ['derivedFrom', 0, 'reference']) for obs in observations])
+    imaging_studies = [index[key] for key in list(index) if key.startswith('ImagingStudy/')]
+    resolve_references(client, index, [get_by_path(study, ['subject', 'reference']) for study in imaging_studies])
+
+def accession_number(imaging_study):
+    for identifier in imaging_study.get('identifier', []):
+        if get_by_path(identifier, ['type', 'coding', 0, 'code']) == 'ACSN':
+            return identifier.get('value')
+    # Studies written before the ACSN identifier kept the accession number in series.0.number
+    return get_by_path(imaging_study, ['series', 0, 'number'])
+
+def patient_age(patient):
+    """Age in the patient-age extension: a valueAge, or a valueString in older records"""
+    extension = get_by_path(patient, ['extension', 0]) or {}
+    if 'valueAge' in extension:
+        return extension['valueAge'].get('value')
+    try:
+        return int(extension.get('valueString'))
+    except (TypeError, ValueError):
+        return None
+
+def image_columns(report):
+    """The image columns of a record, read from its report's presentedForm"""
+    renditions = {form.get('title'): form.get('data') for form in report.get('presentedForm', [])[1:]}
+    return {
+        'image_data': get_by_path(report, ['presentedForm', 0, 'data']),
+        'image_url': get_by_path(report, ['presentedForm', 0, 'url']),
+        'image_content_type': get_by_path(report, ['presentedForm', 0, 'contentType']),
+        'image_title': get_by_path(report, ['presentedForm', 0, 'title']),
+        'preview_data': renditions.get('preview'),
+        'thumbnail_data': renditions.get('thumbnail'),
+    }
+
+def flatten_report(report, index):
+    """Join a DiagnosticReport with its indexed resources into one record"""
+    record = {
+        'recorded_date': report.get('effectiveDateTime'),
+        'sopinstanceUID': report.get('id'),
+        **image_columns(report),
+        'patient_id': None,
+        'gender': None,
+        'age': None
+    }
+
+    patient_key = reference_key(get_by_path(report, ['subject', 'reference']))
+    if patient_key:
+        record['patient_id'] = patient_key.split('/')[1]
+        patient = index.get(patient_key)
+        if patient:
+            record['gender'] = patient.get('gender')
+            record['age'] = patient_age(patient)
+
+    for result in report.get('result', []):
+        observation = index.get(reference_key(result.get('reference')))
+        if not observation:
+            continue
+        code = get_by_path(observation, ['code', 'coding', 0, 'code'])
+        if code == STUDY_OBSERVATION_CODE:
+            record.update({
+                'studyinstanceuid': observation.get('id'),
+                'study_id': get_by_path(observation, ['identifier', 0, 'value']),
+            })
+            record.update(from_components(observation, STUDY_FIELDS_BY_CODE))
+            image = index.get(reference_key(get_by_path(observation, ['derivedFrom', 0, 'reference'])))
+            if image:
+                record.update({
+                    'accession_number': accession_number(image),
+                    'modality': get_by_path(image, ['series', 0, 'modality', 'code']),
+                    'study_description': get_by_path(image, ['series', 0, 'description']),
+                })
+                device = index.get(reference_key(get_by_path(image, ['subject', 'reference'])))
+                if device:
+                    record.update({
+                        'manufacturer': device.get('manufacturer'),
+                        'model_number': device.get('modelNumber'),
+                    })
+        if code == SERIES_OBSERVATION_CODE:
+            record['seriesinstanceuid'] = observation.get('id')
+            record.update(from_components(observation, SERIES_FIELDS_BY_CODE))
+    return record
+
+def is_final_report(report):
+    return report.get('status') == 'final' and get_by_path(report, ['code', 'coding', 0, 'code']) == REPORT_CODE
+
+def latest_update(client):
+    """meta.lastUpdated of the most recently written final report, or None"""
+    bundle = client.execute('DiagnosticReport', method='get', params={
+        'status': REPORT_SEARCH_PARAMS['status'], 'code': REPORT_SEARCH_PARAMS['code'],
+        '_sort': '-_lastUpdated', '_count': 1, '_elements': 'id'})
+    return get_by_path(bundle, ['entry', 0, 'resource', 'meta', 'lastUpdated'])
+
+def iter_records(client, page_size=PAGE_SIZE, images=True, since=None):
+    """Yield one flattened record per final report, a search page at a time.
+
+    Each page brings its reports' Patient, Observations, ImagingStudy and Device via
+    _include, so a page costs one request instead of ~6 per report. With images=False
+    the reports are fetched with _elements and carry no presentedForm, so the image
+    columns stay empty. With since, only reports updated after that instant are read.
+    """
+    params = dict(REPORT_SEARCH_PARAMS, _count=page_size)
+    if not images:
+        params['_elements'] = ','.join(REPORT_ELEMENTS)
+    if since:
+        params['_lastUpdated'] = f'gt{since}'
+    for bundle in iter_bundles(client, 'DiagnosticReport', params):
+        index = {}
+        index_bundle(index, bundle)
+        reports = [entry['resource'] for entry in bundle.get('entry', [])
+                   if entry['resource']['resourceType'] == 'DiagnosticReport'
+                   and get_by_path(entry, ['search', 'mode']) != 'include']
+        resolve_page(client, index, reports)
+        for report in reports:
+            if is_final_report(report):
+                with REGISTRY.timer('flatten_seconds'):
+                    record = flatten_report(report, index)
+                yield record
+
+def fetch_image_columns(client, report_ids):
+    """Image columns of the given reports, by id, read with batched _id searches.
+
+    For a listing fetched with images=False, so only the rows actually shown pay for
+    their presentedForm.
+    """
+    columns = {}
+    for start in range(0, len(report_ids), ID_BATCH_SIZE):
+        ids = report_ids[start:start + ID_BATCH_SIZE]
+        bundle = client.execute('DiagnosticReport', method='get', params={
+            '_id': ','.join(ids), '_elements': 'presentedForm', '_count': len(ids)})
+        for entry in bundle.get('entry', []):
+            columns[entry['resource']['id']] = image_columns(entry['resource'])
+    return columns
+
+class BulkExportError(Exception):
+    """The server does not support $export, or the export job failed"""
+
+def bulk_request(method, url, headers, stream=False):
+    """A $export request, retried on transient errors; one that keeps failing is a BulkExportError"""
+    try:
+        response = call_with_retry(requests.request, method, url, headers=headers, stream=stream,
+                                   timeout=REQUEST_TIMEOUT, hooks={'response': [raise_for_transient]})
+    except TRANSIENT_ERRORS as e:
+        raise BulkExportError(f'{method.upper()} {url} kept failing: {e}') from e
+    REGISTRY.count('fhir_responses_total', status=response.status_code)
+    return response
+
+def run_bulk_export(client, directory, since=None, types=EXPORT_TYPES):
+    """Run a system-level $export job and download its NDJSON files into directory.
+
+    Returns the downloaded paths by resource type. Raises BulkExportError when the
+    server rejects the kick-off request, a request still fails after its retries, the
+    job fails or does not finish within EXPORT_TIMEOUT seconds, so the caller can fall
+    back to searching.
+    """
+    headers = client._build_request_headers()
+    params = {'_type': ','.join(types), '_outputFormat': 'application/fhir+ndjson'}
+    if since:
+        params['_since'] = since
+    with REGISTRY.timer('bulk_export_seconds', stage='kickoff'):
+        response = bulk_request('get', client._build_request_url('$export', params),
+                                dict(headers, Prefer='respond-async'))
+    if response.status_code != 202 or 'Content-Location' not in response.headers:
+        raise BulkExportError(f'$export kick-off returned HTTP {response.status_code}: {response.text[:200]}')
+    status_url = response.headers['Content-Location']
+
+    deadline = time.monotonic() + EXPORT_TIMEOUT
+    with REGISTRY.timer('bulk_export_seconds', stage='wait'):
+        while True:
+            response = bulk_request('get', status_url, headers)
+            if response.status_code == 200:
+                manifest = response.json()
+                break
+            if response.status_code != 202:
+                raise BulkExportError(f'$export job failed with HTTP {response.status_code}: {response.text[:200]}')
+            if time.monotonic() > deadline:
+                bulk_request('delete', status_url, headers)
+                raise BulkExportError(f'$export job did not finish within {EXPORT_TIMEOUT:.0f}s')
+            logger.info(f"Waiting for $export job ({response.headers.get('X-Progress', 'in progress')})")
+            time.sleep(retry_after(response.headers) or EXPORT_POLL_INTERVAL)
+
+    # Output files may live elsewhere (e.g. object storage); only send the token when asked to
+    file_headers = headers if manifest.get('requiresAccessToken') else {}
+    paths = defaultdict(list)
+    with REGISTRY.timer('bulk_export_seconds', stage='download'):
+        for i, output in enumerate(manifest.get('output', [])):
+            path = os.path.join(directory, f"{output['type']}.{i}.ndjson")
+            with bulk_request('get', output['url'], file_headers, stream=True) as response:
+                if response.status_code != 200:
+                    raise BulkExportError(f"Downloading {output['url']} returned HTTP {response.status_code}")
+                with open(path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+                        REGISTRY.count('fhir_bytes_received_total', len(chunk))
+            paths[output['type']].append(path)
+    logger.info(f"Downloaded {sum(len(files) for files in paths.values())} $export files")
+    return paths
+
+def read_ndjson(path):
+    """Yield the resources of an NDJSON file, gzip-compressed if it ends in .gz"""
+    with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_ndjson_records(paths, images=True):
+    """Yield one flattened record per final report from NDJSON files grouped by resource type.
+
+    Patients, Devices, ImagingStudies and Observations are indexed first, then the
+    reports are streamed and joined against the index in a single pass. Also reads
+    the files written by bulk_export. With images=False each report's presentedForm
+    is dropped as it is read, so the image columns stay empty as with iter_records.
+    """
+    index = {}
+    for resource_type in EXPORT_TYPES[:-1]:
+        for path in paths.get(resource_type, []):
+            for resource in read_ndjson(path):
+                index[f"{resource['resourceType']}/{resource['id']}"] = resource
+    for path in paths.get('DiagnosticReport', []):
+        for report in read_ndjson(path):
+            if not images:
+                report.pop('presentedForm', None)
+            if is_final_report(report):
+                with REGISTRY.timer('flatten_seconds'):
+                    record = flatten_report(report, index)
+                yield record
+
+def iter_bulk_records(client, page_size=PAGE_SIZE, images=True, since=None):
+    """iter_records through $export, falling back to paged search if the server cannot export"""
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = run_bulk_export(client, directory, since)
+            yield from iter_ndjson_records(paths, images)
+        return
+    except BulkExportError as e:
+        logger.warning(f"Bulk export unavailable ({e}), falling back to paged search")
+    yield from iter_records(client, page_size=page_size, images=images, since=since)
+
+def iter_chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def export_records(client, path, file_format='csv', images=False, chunk_size=PAGE_SIZE, bulk=False,
+                   partition_by=None):
+    """Stream records to a CSV, Parquet or Arrow (IPC) file a chunk at a time; returns the row count.
+
+    Parquet and Arrow columns are typed (see record_schema). With partition_by (e.g.
+    ['modality'] or ['recorded_date']) path becomes a Hive-partitioned dataset
+    directory, replaced as a whole once complete. With bulk, the records are read
+    through $export (see iter_bulk_records).
+    """
+    columns = RECORD_COLUMNS if images else [column for column in RECORD_COLUMNS if column not in IMAGE_COLUMNS]
+    read = iter_bulk_records if bulk else iter_records
+    records = read(client, page_size=chunk_size, images=images)
+    count = 0
+
+    if file_format in ('parquet', 'arrow'):
+        import pyarrow as pa
+
+        schema = record_schema(columns)
+        if partition_by:
+            return write_partitioned(iter_chunks(records, chunk_size), path, schema, file_format, partition_by)
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(path, schema)
+        else:
+            writer = pa.ipc.new_file(path, schema)
+        with writer:
+            for chunk in iter_chunks(records, chunk_size):
+                writer.write_table(records_to_table(chunk, schema))
+                count += len(chunk)
+        return count
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow({column: csv_value(record.get(column)) for column in columns})
+            count += 1
+    return count
+
+def write_partitioned(chunks, path, schema, file_format, partition_by):
+    """Write each chunk into a partitioned dataset next to path, then swap it in for path"""
+    import pyarrow.dataset as ds
+
+    directory = tempfile.mkdtemp(prefix=os.path.basename(path.rstrip('/')) + '.', dir=os.path.dirname(path) or '.')
+    count = 0
+    try:
+        for i, chunk in enumerate(chunks):
+            ds.write_dataset(records_to_table(chunk, schema), directory,
+                             format='parquet' if file_format == 'parquet' else 'ipc',
+                             partitioning=partition_by, partitioning_flavor='hive',
+                             basename_template=f'part-{i:05d}-{{i}}.{file_format}',
+                             existing_data_behavior='overwrite_or_ignore')
+            count += len(chunk)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(directory, path)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return count
+
+def record_schema(columns):
+    """Arrow schema of the typed export: numbers as int64/float64, multi-valued ones as lists"""
+    import pyarrow as pa
+
+    types = {'integer': pa.int64(), 'decimal': pa.float64(), 'decimals': pa.list_(pa.float64())}
+    column_types = {field.column: types.get(field.kind, pa.string()) for field in STUDY_FIELDS + SERIES_FIELDS}
+    column_types.update(recorded_date=pa.date32(), age=pa.int64())
+    return pa.schema([(column, column_types.get(column, pa.string())) for column in columns])
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
+
+def records_to_table(records, schema):
+    import pyarrow as pa
+
+    def convert(value, column_type):
+        if value is None:
+            return None
+        if column_type == pa.string():
+            return value if isinstance(value, str) else csv_value(value)
+        if column_type == pa.date32():
+            return parse_date(value)
+        return value
+
+    return pa.Table.from_pydict(
+        {field.name: [convert(record.get(field.name), field.type) for record in records] for field in schema},
+        schema=schema)
+
+def csv_value(value):
+    """Multi-valued fields are written DICOM style, as a\\b"""
+    if isinstance(value, list):
+        return '\\'.join('' if item is None else str(item) for item in value)
+    return value
+
+async def main(output_path='dicom_dataset.csv', file_format='csv', images=True, bulk=False, partition_by=None):
 
     # Set up the FHIR client
-    client = SyncFHIRClient(
-        url=FHIR_URL, 
+    client = RetryingFHIRClient(
+        url=FHIR_URL,
         # authorization=f"Bearer {access_token}",
         extra_headers={"Content-Type": "application/fhir+json"})
-    
-    # Create a list to store all records
-    all_records = []
-    
-    reports = client.resources('DiagnosticReport').fetch_all() 
-    for report in reports:
-        if report['status'] == 'final' and report['code']['coding'][0]['code'] == '36642-7':
-            # Initialize a dictionary for each record
-            record = {
-                'recorded_date': report.get('effectiveDateTime'),
-                'sopinstanceUID': report.get('id'),
-                'image_data': report.get_by_path('presentedForm.0.data'),
-                'image_title': report.get_by_path('presentedForm.0.title'),
-                'patient_id': None,
-                'gender': None,
-                'age': None
-            }
-
-            patient_data = report.get_by_path('subject.reference')
-            if patient_data is not None and '/' in patient_data:
-                patient_id = patient_data.split('/')[1]
-                record['patient_id'] = patient_id
-                patients = client.resources('Patient').search(_id=patient_id).fetch_all()
-                for patient in patients:
-                    record['gender'] = patient.get('gender')
-                    record['age'] = patient.get_by_path("extension.0.valueString")
-            
-            for observation in report.get('result', []):
-                reference = observation.get('reference')
-                if reference:
-                    obs_id = reference.split('/')[1]
-                    body_paths = client.resources('Observation').search(_id=obs_id).fetch_all()
-                    for body_path in body_paths:
-                        code = body_path.get_by_path('code.coding.0.code')
-                        if code == '65737-9':
-                            record.update({
-                                'studyinstanceuid': body_path.get('id'),
-                                'study_id': body_path.get_by_path('identifier.0.value'),
-                                'body_part_examined': body_path.get_by_path('component.0.valueString'),
-                                'scan_options': body_path.get_by_path('component.1.valueString'),
-                                'scan_mode': body_path.get_by_path('component.2.valueString'),
-                                'kvp': body_path.get_by_path('component.3.valueString'),
-                                'collection_diameter': body_path.get_by_path('component.4.valueString'),
-                                'protocol_name': body_path.get_by_path('component.5.valueString'),
-                                'reconstruction_diameter': body_path.get_by_path('component.6.valueString'),
-                                'gantry_detector_tilt': body_path.get_by_path('component.7.valueString'),
-                                'table_height': body_path.get_by_path('component.8.valueString'),
-                                'rotation_direction': body_path.get_by_path('component.9.valueString'),
-                                'exposure_time': body_path.get_by_path('component.10.valueString'),
-                                'xray_tube_current': body_path.get_by_path('component.11.valueString'),
-                                'exposure': body_path.get_by_path('component.12.valueString'),
-                                'filter_type': body_path.get_by_path('component.13.valueString'),
-                                'generator_power': body_path.get_by_path('component.14.valueString'),
-                                'focal_spots': body_path.get_by_path('component.15.valueString'),
-                                'convolution_kernel': body_path.get_by_path('component.16.valueString'),
-                                'patient_position': body_path.get_by_path('component.17.valueString'),
-                                'spiral_pitch_factor': body_path.get_by_path('component.18.valueString'),
-                                'ctdi_vol': body_path.get_by_path('component.19.valueString'),
-                            })
-                            imaging_data = body_path.get_by_path('derivedFrom.0.reference')
-                            if imaging_data is not None and '/' in patient_data:
-                                image_id = imaging_data.split('/')[1]
-                                images = client.resources('ImagingStudy').search(_id=image_id).fetch_all()
-                                for image in images:
-                                    record.update({
-                                        'accession_number': image.get_by_path('series.0.number'),
-                                        'modality': image.get_by_path('series.0.modality.code'),
-                                        'study_description': image.get_by_path('series.0.description'),
-                                    })
-                                    device_data = image.get_by_path('subject.reference')
-                                    # print(device_data)
-                                    if device_data is not None and '/' in device_data:
-                                        device_id = device_data.split('/')[1]
-                                        devices = client.resources('Device').search(_id=device_id).fetch_all()
-                                        # print(devices)
-                                        for device in devices:
-                                            record.update({
-                                                'manufacturer': device.get('manufacturer'),
-                                                'model_number': device.get('modelNumber'),
-                                            })
-                            
-                        if code == '65737-8':
-                            record.update({
-                                'seriesinstanceuid': body_path.get('id'),
-                                'seriesnumber': body_path.get_by_path('component.0.valueString'),
-                                'acquisitionnumber': body_path.get_by_path('component.1.valueString'),
-                                'instancenumber': body_path.get_by_path('component.2.valueString'),
-                                'patientorientation': body_path.get_by_path('component.3.valueString'),
-                                'imagepositionpatient': body_path.get_by_path('component.4.valueString'),
-                                'imageorientationpatient': body_path.get_by_path('component.5.valueString'),
-                                'frameofreferenceuid': body_path.get_by_path('component.6.valueString'),
-                                'positionreferenceindicator': body_path.get_by_path('component.7.valueString'),
-                                'slicelocation': body_path.get_by_path('component.8.valueString'),
-                                'samplesperpixel': body_path.get_by_path('component.9.valueString'),
-                                'photometricinterpretation': body_path.get_by_path('component.10.valueString'),
-                                'rows': body_path.get_by_path('component.11.valueString'),
-                                'columns': body_path.get_by_path('component.12.valueString'),
-                                'pixelspacing': body_path.get_by_path('component.13.valueString'),
-                                'bitsallocated': body_path.get_by_path('component.14.valueString'),
-                                'bitsstored': body_path.get_by_path('component.15.valueString'),
-                                'highbit': body_path.get_by_path('component.16.valueString'),
-                                'pixelrepresentation': body_path.get_by_path('component.17.valueString'),
-                                'windowcenter': body_path.get_by_path('component.18.valueString'),
-                                'windowwidth': body_path.get_by_path('component.19.valueString'),
-                                'rescaleintercept': body_path.get_by_path('component.20.valueString'),
-                                'rescalevalue': body_path.get_by_path('component.21.valueString'),
-                                'performedproceduresstepid': body_path.get_by_path('component.22.valueString'),
-                                # 'pixeldata': body_path.get_by_path('component.23.valueString'),
-                            })
-            
-            # Add the complete record to our list
-            all_records.append(record)
-
-    # Create DataFrame and save to CSV
-    df = pd.DataFrame(all_records)
-    df.to_csv('dicom_dataset.csv', index=False)
-    print(f"Data saved to dicom_data.csv with {len(all_records)} records")
+
+    # Stream the records to disk page by page
+    count = export_records(client, output_path, file_format=file_format, images=images, bulk=bulk,
+                           partition_by=partition_by)
+    print(f"Data saved to {output_path} with {count} records")
 
 if __name__ == "__main__":
     import asyncio
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
\ No newline at end of file
+    loop.run_until_complete(main())
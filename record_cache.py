@@ -0,0 +1,96 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecordCache:
+    """Flattened FHIR records per query, refreshed by delta instead of full reloads.
+
+    Entries are held in an in-process LRU of at most `max_queries` queries and, when
+    `path` is set, in a SQLite file so they survive a restart. Each entry keeps the
+    newest DiagnosticReport meta.lastUpdated it has seen. Within `ttl` seconds of the
+    last check it is served as is; after that, or once invalidate() is called, the
+    server's newest lastUpdated is compared and only reports updated since are
+    fetched and merged by SOPInstanceUID. Deleted reports are not noticed until
+    clear() is called.
+    """
+
+    def __init__(self, path=None, ttl=60, max_queries=4):
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.entries = OrderedDict()
+        # Streamlit runs each session in its own thread
+        self.lock = threading.Lock()
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, last_updated TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS records (key TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, "
+                "PRIMARY KEY (key, id))")
+            self.connection.commit()
+
+    def get(self, key, latest, fetch):
+        """Return the records of query `key`.
+
+        latest() returns the server's newest lastUpdated for the query, fetch(since)
+        the records updated after since (all of them when since is None).
+        """
+        with self.lock:
+            entry = self.entries.get(key) or self.load(key)
+            if entry is None or time.monotonic() - entry["checked_at"] >= self.ttl:
+                # Taken before fetching, so anything written meanwhile is fetched again next time
+                last_updated = latest()
+                if entry is None:
+                    entry = {"records": {}, "last_updated": None}
+                    changed = list(fetch(None))
+                elif last_updated != entry["last_updated"]:
+                    changed = list(fetch(entry["last_updated"]))
+                else:
+                    changed = []
+                entry["records"].update((record["sopinstanceUID"], record) for record in changed)
+                entry["last_updated"] = last_updated
+                entry["checked_at"] = time.monotonic()
+                self.store(key, entry, changed)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_queries:
+                self.entries.popitem(last=False)
+            return list(entry["records"].values())
+
+    def invalidate(self):
+        """Make the next get() of every query check the server for updates"""
+        with self.lock:
+            for entry in self.entries.values():
+                entry["checked_at"] = float("-inf")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.connection:
+                self.connection.execute("DELETE FROM queries")
+                self.connection.execute("DELETE FROM records")
+                self.connection.commit()
+
+    def load(self, key):
+        if not self.connection:
+            return None
+        row = self.connection.execute("SELECT last_updated FROM queries WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        records = {record_id: json.loads(body) for record_id, body in self.connection.execute(
+            "SELECT id, body FROM records WHERE key = ? ORDER BY rowid", (key,))}
+        return {"records": records, "last_updated": row[0], "checked_at": float("-inf")}
+
+    def store(self, key, entry, changed):
+        if not self.connection:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO queries VALUES (?, ?)", (key, entry["last_updated"]))
+        self.connection.executemany(
+            # An upsert keeps the rowid, so reloaded records come back in their original order
+            "INSERT INTO records VALUES (?, ?, ?) ON CONFLICT (key, id) DO UPDATE SET body = excluded.body",
+            [(key, record["sopinstanceUID"], json.dumps(record, default=str)) for record in changed])
+        self.connection.commit()
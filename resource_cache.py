@@ -0,0 +1,117 @@
+import copy
+import hashlib
+import json
+
+from streaming import hash_default
+
+
+def content_hash(resource):
+    return hashlib.sha256(json.dumps(resource, sort_keys=True, default=hash_default).encode()).hexdigest()
+
+
+def merge_imaging_study(aggregate, imaging_study):
+    """Fold the series and instances of imaging_study into aggregate"""
+    series_by_uid = {series["uid"]: series for series in aggregate["series"]}
+    for series in imaging_study["series"]:
+        existing = series_by_uid.get(series["uid"])
+        if existing is None:
+            existing = series_by_uid[series["uid"]] = copy.deepcopy(series)
+            aggregate["series"].append(existing)
+        else:
+            instance_uids = {instance["uid"] for instance in existing["instance"]}
+            existing["instance"].extend(
+                copy.deepcopy(instance) for instance in series["instance"] if instance["uid"] not in instance_uids)
+        existing["numberOfInstances"] = len(existing["instance"])
+    aggregate["numberOfSeries"] = len(aggregate["series"])
+    aggregate["numberOfInstances"] = sum(series["numberOfInstances"] for series in aggregate["series"])
+
+
+class ResourceCache:
+    """Resources already written, keyed by Type/id plus a hash of their content.
+
+    Slices of one study share their Patient and study Observation, so those are only
+    written when their content changes. ImagingStudies are written once when first
+    seen (later resources reference them), and added() merges the instance of every
+    file whose upload succeeded into one aggregate per study; stale_studies() returns
+    the aggregates still to be written at the end of the run. With a Manifest the
+    hashes and aggregates also persist across runs.
+    """
+
+    def __init__(self, manifest=None):
+        self.manifest = manifest
+        self.hashes = {}
+        self.studies = {}  # key: aggregate, or None until a file of the study is added
+
+    def written_hash(self, key):
+        if key not in self.hashes and self.manifest:
+            self.hashes[key] = self.manifest.resource_hash(key)
+        return self.hashes.get(key)
+
+    def load_study(self, key):
+        if key not in self.studies:
+            self.studies[key] = self.manifest.resource_body(key) if self.manifest else None
+
+    def unseeded(self, resources):
+        """Type/ids of the ImagingStudies in resources whose stored version has to be fetched first.
+
+        With a manifest the aggregates come from it. Without one the caller reads each
+        of these from the server and passes it to seed(), so that writing the
+        aggregate keeps the instances earlier runs stored.
+        """
+        if self.manifest:
+            return []
+        return list(dict.fromkeys(f"ImagingStudy/{resource['id']}" for resource in resources
+                                  if resource["resourceType"] == "ImagingStudy"
+                                  and f"ImagingStudy/{resource['id']}" not in self.studies))
+
+    def seed(self, key, stored):
+        """Start a study's aggregate from the version on the server (None if there is none)"""
+        if key in self.studies:
+            return
+        self.studies[key] = None
+        if stored:
+            self.studies[key] = {name: value for name, value in stored.items() if name not in ("meta", "text")}
+            # Already on the server, so it is not written again when first seen
+            self.hashes[key] = content_hash(self.studies[key])
+
+    def unwritten(self, resources):
+        """Return the resources that still need writing"""
+        pending = []
+        for resource in resources:
+            key = f"{resource['resourceType']}/{resource['id']}"
+            if resource["resourceType"] == "ImagingStudy":
+                self.load_study(key)
+                if self.written_hash(key) is None:
+                    pending.append(resource)
+            elif self.written_hash(key) != content_hash(resource):
+                pending.append(resource)
+        return pending
+
+    def written(self, resources):
+        for resource in resources:
+            key = f"{resource['resourceType']}/{resource['id']}"
+            self.hashes[key] = content_hash(resource)
+            if self.manifest:
+                body = self.studies.get(key) or (resource if resource["resourceType"] == "ImagingStudy" else None)
+                self.manifest.record_resource(key, self.hashes[key], body)
+
+    def added(self, resources):
+        """Merge the ImagingStudy instances of a file whose resources were all saved into their aggregates"""
+        for resource in resources:
+            if resource["resourceType"] == "ImagingStudy":
+                key = f"{resource['resourceType']}/{resource['id']}"
+                self.load_study(key)
+                if self.studies[key] is None:
+                    self.studies[key] = {**copy.deepcopy(resource), "series": []}
+                merge_imaging_study(self.studies[key], resource)
+
+    def unsaved(self, studies):
+        """Keep aggregates whose final write failed in the manifest, still marked stale, for the next run"""
+        for study in studies:
+            key = f"ImagingStudy/{study['id']}"
+            if self.manifest:
+                self.manifest.record_resource(key, self.written_hash(key) or "", study)
+
+    def stale_studies(self):
+        return [study for key, study in self.studies.items()
+                if study is not None and self.written_hash(key) != content_hash(study)]
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+import aiohttp
+import requests
+from fhirpy import SyncFHIRClient
+from fhirpy.base.exceptions import OperationOutcome, ResourceNotFound
+from fhirpy.base.utils import AttrDict
+
+from metrics import REGISTRY
+from streaming import JSONStream, raw_binary
+
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = int(os.environ.get("retry_attempts", 5))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# Seconds before a request to the FHIR server is abandoned (and retried)
+REQUEST_TIMEOUT = float(os.environ.get("fhir_timeout", 60))
+# Throttling and server-side failures worth another attempt; 4xx responses are not
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Sent with every PUT; the converter never reads the stored resource back
+PUT_HEADERS = {"Prefer": "return=minimal"}
+
+
+class TransientHTTPError(Exception):
+    def __init__(self, status, body="", retry_after=None):
+        super().__init__(f"HTTP {status}: {body[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+TRANSIENT_ERRORS = (TransientHTTPError, requests.ConnectionError, requests.Timeout,
+                    aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+def retry_after(headers):
+    """Seconds asked for by a Retry-After header, if given as a number"""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with full jitter, unless the server said how long to wait"""
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def request_labels(method, path):
+    """Metric labels of a request: the method and the resource type it targets ("bundle" for /)"""
+    # Paging links are absolute URLs; resource types are the capitalised segments
+    segments = [segment for segment in path.split("?")[0].split("/") if segment[:1].isupper()]
+    return {"method": method.upper(), "resource": segments[0] if segments else "bundle"}
+
+
+def record_response(response, *args, **kwargs):
+    """requests response hook: count the status and the bytes each way"""
+    REGISTRY.count("fhir_responses_total", status=response.status_code)
+    REGISTRY.count("fhir_bytes_sent_total", len(response.request.body or b""))
+    REGISTRY.count("fhir_bytes_received_total", len(response.content))
+
+
+def raise_for_transient(response, *args, **kwargs):
+    """requests response hook: turn retryable statuses into TransientHTTPError before fhirpy parses them"""
+    if response.status_code in RETRY_STATUSES:
+        raise TransientHTTPError(response.status_code, response.text, retry_after(response.headers))
+
+
+def call_with_retry(func, *args, attempts=RETRY_ATTEMPTS, **kwargs):
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+            logger.warning(f"Transient error ({e}), retrying in {delay:.1f}s [{attempt + 1}/{attempts - 1}]")
+            REGISTRY.count("fhir_retries_total")
+            time.sleep(delay)
+
+
+async def async_call_with_retry(func, *args, attempts=RETRY_ATTEMPTS, **kwargs):
+    for attempt in range(attempts):
+        try:
+            return await func(*args, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+            logger.warning(f"Transient error ({e}), retrying in {delay:.1f}s [{attempt + 1}/{attempts - 1}]")
+            REGISTRY.count("fhir_retries_total")
+            await asyncio.sleep(delay)
+
+
+class RetryingFHIRClient(SyncFHIRClient):
+    """SyncFHIRClient that retries timeouts, dropped connections, 429 and 5xx responses.
+
+    Every write in this converter is a PUT (or a Bundle of PUTs) to a client-assigned
+    id, so repeating a request whose outcome is unknown is safe. Each call is timed
+    per method and resource type, and the bytes sent and received are counted.
+    Request bodies are streamed through JSONStream, so base64 payloads are encoded
+    as they are sent rather than held in memory as one JSON string.
+    """
+
+    def __init__(self, url, attempts=RETRY_ATTEMPTS, **kwargs):
+        requests_config = {"timeout": REQUEST_TIMEOUT, "hooks": {"response": [record_response, raise_for_transient]}}
+        requests_config.update(kwargs.pop("requests_config", None) or {})
+        super().__init__(url, requests_config=requests_config, **kwargs)
+        self.attempts = attempts
+
+    def put(self, resource):
+        """Create or update resource by id; a Binary held in memory goes up as its raw bytes.
+
+        The server is asked not to echo the resource back, which would be as large as the upload.
+        """
+        path = f"{resource['resourceType']}/{resource['id']}"
+        raw = raw_binary(resource)
+        if raw:
+            return self._do_request("put", path, data=raw[0],
+                                    extra_headers={**PUT_HEADERS, "Content-Type": raw[1]})
+        return self._do_request("put", path, data=resource, extra_headers=PUT_HEADERS)
+
+    def _do_request(self, method, path, data=None, *args, **kwargs):
+        request = super()._do_request if data is None else self._send_body
+        with REGISTRY.timer("fhir_request_seconds", **request_labels(method, path)):
+            return call_with_retry(request, method, path, data, *args, attempts=self.attempts, **kwargs)
+
+    def _send_body(self, method, path, data, params=None, extra_headers=None, *, returning_status=False):
+        """fhirpy's request, with the body streamed (or sent as is, when it is raw bytes)"""
+        headers = {**self._build_request_headers(), **(extra_headers or {})}
+        body = data if isinstance(data, bytes) else JSONStream(data)
+        r = requests.request(method, self._build_request_url(path, params), data=body, headers=headers,
+                             **self.requests_config)
+        if 200 <= r.status_code < 300:
+            is_json = r.content and "json" in r.headers.get("Content-Type", "")
+            r_data = json.loads(r.content.decode(), object_hook=AttrDict) if is_json else None
+            return (r_data, r.status_code) if returning_status else r_data
+        if r.status_code in (404, 410):
+            raise ResourceNotFound(r.content.decode())
+        raise OperationOutcome(reason=f"HTTP {r.status_code}: {r.content.decode()}")
@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import uuid
+
+# Raw bytes per base64 chunk; a multiple of 3, so the chunks concatenate without padding
+CHUNK_SIZE = 3 * 64 * 1024
+# PUT Binary resources as their raw bytes and content type instead of base64 JSON
+RAW_BINARY = os.environ.get("raw_binary", "1") != "0"
+
+
+class Base64Payload:
+    """Binary data that is only base64-encoded, a chunk at a time, when written out.
+
+    build_resources puts these where FHIR wants a base64 string (pixel data, image
+    renditions), so a resource holds each payload once, as raw bytes. JSONStream
+    encodes them while a request body or NDJSON line is being written.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._digest = None
+
+    def __reduce__(self):
+        # Sent to and from the parse workers as plain bytes
+        return Base64Payload, (bytes(self.data),)
+
+    @property
+    def encoded_length(self):
+        return 4 * ((len(self.data) + 2) // 3)
+
+    def chunks(self, size=CHUNK_SIZE):
+        view = memoryview(self.data)
+        for start in range(0, len(view), size):
+            yield base64.b64encode(view[start:start + size])
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = "sha256:" + hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    def __str__(self):
+        return base64.b64encode(self.data).decode("ascii")
+
+
+def hash_default(value):
+    """json.dumps default for content hashes: a payload stands for the digest of its bytes"""
+    return value.digest() if isinstance(value, Base64Payload) else str(value)
+
+
+class JSONStream:
+    """A JSON document whose Base64Payloads are encoded only as it is iterated.
+
+    The rest of the document is serialised up front with each payload replaced by a
+    marker, so len() gives the exact size in bytes (for Content-Length) and each
+    iteration yields the same chunks again (for retries).
+    """
+
+    def __init__(self, value):
+        token = uuid.uuid4().hex
+        payloads = []
+
+        def default(obj):
+            if isinstance(obj, Base64Payload):
+                payloads.append(obj)
+                return f"{token}:{len(payloads) - 1}"
+            raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+        text = json.dumps(value, default=default)
+        parts = re.split(f"{token}:(\\d+)", text)
+        # Segments alternate with payload indexes; the markers sit inside the JSON string quotes
+        self.segments = [part.encode("ascii") for part in parts[::2]]
+        self.payloads = [payloads[int(index)] for index in parts[1::2]]
+
+    def __len__(self):
+        return sum(map(len, self.segments)) + sum(payload.encoded_length for payload in self.payloads)
+
+    def __iter__(self):
+        for segment, payload in zip(self.segments, self.payloads):
+            yield segment
+            yield from payload.chunks()
+        yield self.segments[-1]
+
+    async def aiter(self):
+        for chunk in self:
+            yield chunk
+
+
+def raw_binary(resource):
+    """The (bytes, content type) to PUT a Binary resource as raw content, or None to send it as JSON"""
+    if RAW_BINARY and resource["resourceType"] == "Binary" and isinstance(resource.get("data"), Base64Payload):
+        return resource["data"].data, resource["contentType"]
+    return None
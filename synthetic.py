@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import (ExplicitVRLittleEndian, generate_uid, CTImageStorage, ComputedRadiographyImageStorage,
+                         EnhancedCTImageStorage)
+
+SOP_CLASSES = {"CT": CTImageStorage, "CR": ComputedRadiographyImageStorage}
+
+
+def item(**elements):
+    ds = Dataset()
+    for keyword, value in elements.items():
+        setattr(ds, keyword, value)
+    return ds
+
+
+def make_dataset(modality, patient_id, study_uid, series_uid, series_number, instance_number, size, rng,
+                 patient=("M", "045Y"), frames=1):
+    """One synthetic instance with the attributes main.build_resources reads.
+
+    With frames > 1 (CT only) it is an Enhanced CT object: the frames share their pixel
+    measures, rescale and window through the shared functional groups, and each frame
+    has its own position.
+    """
+    if frames > 1 and modality != "CT":
+        raise ValueError("Only CT can be generated as a multi-frame (Enhanced CT) object")
+    sop_class = EnhancedCTImageStorage if frames > 1 else SOP_CLASSES[modality]
+    sop_instance_uid = generate_uid()
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.PatientID = patient_id
+    ds.PatientSex, ds.PatientAge = patient
+    ds.StudyInstanceUID = study_uid
+    ds.StudyDate = "20240115"
+    ds.StudyTime = "120000"
+    ds.StudyID = study_uid[-8:]
+    ds.AccessionNumber = study_uid[-10:]
+    ds.StudyDescription = f"Synthetic {modality}"
+    ds.Modality = modality
+    ds.Manufacturer = "Synthetic"
+    ds.ManufacturerModelName = "Benchmark"
+    ds.BodyPartExamined = "CHEST"
+    ds.ProtocolName = "Benchmark"
+    ds.PatientPosition = "HFS"
+    ds.KVP = "120"
+    ds.ExposureTime = "500"
+    ds.XRayTubeCurrent = "200"
+    ds.Exposure = "100"
+    ds.FilterType = "BODY"
+    ds.FocalSpots = ["0.7", "1.2"]
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = str(series_number)
+    ds.AcquisitionNumber = "1"
+    ds.InstanceNumber = str(instance_number)
+    ds.PerformedProcedureStepID = "PPS1"
+    if modality == "CT":
+        ds.ScanOptions = "HELICAL"
+        ds.SliceThickness = "1.25"
+        ds.DataCollectionDiameter = "500"
+        ds.ReconstructionDiameter = "350"
+        ds.GantryDetectorTilt = "0"
+        ds.TableHeight = "150"
+        ds.RotationDirection = "CW"
+        ds.GeneratorPower = "60"
+        ds.ConvolutionKernel = "B30f"
+        ds.SpiralPitchFactor = 0.9
+        ds.CTDIvol = 12.5
+        ds.ImagePositionPatient = ["-175", "-175", str(instance_number * 1.25)]
+        ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+        ds.FrameOfReferenceUID = study_uid
+        ds.SliceLocation = str(instance_number * 1.25)
+        ds.RescaleIntercept = "-1024"
+        ds.RescaleSlope = "1"
+        ds.WindowCenter = "40"
+        ds.WindowWidth = "400"
+        ds.PhotometricInterpretation = "MONOCHROME2"
+    else:
+        ds.PatientOrientation = ["L", "F"]
+        ds.WindowCenter = "2048"
+        ds.WindowWidth = "4096"
+        ds.PhotometricInterpretation = "MONOCHROME1"
+
+    ds.SamplesPerPixel = 1
+    ds.Rows = ds.Columns = size
+    ds.PixelSpacing = ["0.7", "0.7"]
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    # A smooth gradient plus noise, so the renditions compress like real images rather than like noise
+    gradient = np.add.outer(np.arange(size), np.arange(size)) * (4095 / (2 * size))
+    noise = rng.normal(0, 60, (frames, size, size))
+    ds.PixelData = np.clip(gradient + noise, 0, 4095).astype(np.uint16).tobytes()
+
+    if frames > 1:
+        ds.NumberOfFrames = frames
+        ds.SharedFunctionalGroupsSequence = Sequence([item(
+            PixelMeasuresSequence=Sequence([item(PixelSpacing=ds.PixelSpacing, SliceThickness=ds.SliceThickness)]),
+            PixelValueTransformationSequence=Sequence([item(RescaleIntercept=ds.RescaleIntercept,
+                                                            RescaleSlope=ds.RescaleSlope, RescaleType="HU")]),
+            FrameVOILUTSequence=Sequence([item(WindowCenter=ds.WindowCenter, WindowWidth=ds.WindowWidth)]),
+        )])
+        ds.PerFrameFunctionalGroupsSequence = Sequence([item(
+            PlanePositionSequence=Sequence([item(ImagePositionPatient=["-175", "-175", str(frame * 1.25)])]),
+        ) for frame in range(frames)])
+        # Enhanced objects keep these in the functional groups only
+        for keyword in ("PixelSpacing", "SliceThickness", "RescaleIntercept", "RescaleSlope", "WindowCenter",
+                        "WindowWidth", "ImagePositionPatient", "SliceLocation"):
+            delattr(ds, keyword)
+    return ds
+
+
+def save(ds, path):
+    """Write ds as a Part 10 file, with preamble and file meta"""
+    try:
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:  # pydicom < 3
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.save_as(path, write_like_original=False)
+
+
+def generate(directory, modality="CT", studies=1, series=1, instances=10, size=512, seed=0, frames=1):
+    """Write a study/series tree of synthetic instances and return the file paths.
+
+    Files are laid out as <directory>/study<N>/series<N>/IM<N>.dcm, like a PACS export.
+    With frames > 1 each instance is a multi-frame Enhanced CT object.
+    """
+    rng = np.random.default_rng(seed)
+    paths = []
+    for study_index in range(studies):
+        study_uid = generate_uid()
+        patient_id = f"BENCH{study_index:04d}"
+        patient = (str(rng.choice(["M", "F"])), f"{rng.integers(18, 90):03d}Y")
+        for series_index in range(series):
+            series_uid = generate_uid()
+            series_directory = os.path.join(directory, f"study{study_index}", f"series{series_index}")
+            os.makedirs(series_directory, exist_ok=True)
+            for instance_index in range(instances):
+                ds = make_dataset(modality, patient_id, study_uid, series_uid, series_index + 1,
+                                  instance_index + 1, size, rng, patient, frames)
+                path = os.path.join(series_directory, f"IM{instance_index}.dcm")
+                save(ds, path)
+                paths.append(path)
+    return paths
@@ -0,0 +1,93 @@
+import asyncio
+import base64
+import json
+import os
+
+import pydicom
+import pytest
+
+# main reads the server URL when imported; the server test points it at a MockFHIRServer
+os.environ.setdefault("local_url", "http://127.0.0.1:1/fhir")
+
+import main
+import pipeline
+from mapping import STUDY_FIELDS, SERIES_FIELDS, read_value
+from mock_fhir import MockFHIRServer
+from resource_cache import ResourceCache
+from streaming import Base64Payload, JSONStream
+from synthetic import generate
+
+FIELDS = {field.keyword: field for field in STUDY_FIELDS + SERIES_FIELDS}
+
+
+def imaging_study(series_uid, instance_uid):
+    return {"resourceType": "ImagingStudy", "id": "1.2.3", "numberOfSeries": 1, "numberOfInstances": 1,
+            "series": [{"uid": series_uid, "numberOfInstances": 1, "instance": [{"uid": instance_uid}]}]}
+
+
+def test_failed_entries():
+    bundle = main.make_bundle([{"resourceType": "Patient", "id": str(i)} for i in range(3)], "batch")
+    response = {"entry": [
+        {"response": {"status": "201 Created"}},
+        {"response": {"status": "422 Unprocessable Entity",
+                      "outcome": {"issue": [{"code": "processing", "diagnostics": "bad reference"}]}}},
+    ]}
+    assert main.failed_entries(bundle, response) == {
+        "Patient/1": "HTTP 422 Unprocessable Entity: bad reference",
+        "Patient/2": "HTTP missing: no details",
+    }
+    assert main.failed_entries(bundle, {"entry": [{"response": {"status": "200"}}] * 3}) == {}
+
+
+def test_added_merges_instances_into_one_study():
+    cache = ResourceCache()
+    cache.added([imaging_study("1.2.3.1", "1.2.3.1.1")])
+    cache.added([imaging_study("1.2.3.1", "1.2.3.1.2")])
+    cache.added([imaging_study("1.2.3.2", "1.2.3.2.1")])
+    cache.added([imaging_study("1.2.3.1", "1.2.3.1.1")])  # the same file again
+    [study] = cache.stale_studies()
+    assert [len(series["instance"]) for series in study["series"]] == [2, 1]
+    assert (study["numberOfSeries"], study["numberOfInstances"]) == (2, 3)
+    cache.written([study])
+    assert cache.stale_studies() == []
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 1000, 3 * 64 * 1024 + 1])
+def test_json_stream_length_matches_body(size):
+    data = os.urandom(size)
+    stream = JSONStream({"resourceType": "Binary", "data": Base64Payload(data), "other": [Base64Payload(b"x")]})
+    body = b"".join(stream)
+    assert len(stream) == len(body)
+    assert base64.b64decode(json.loads(body)["data"]) == data
+
+
+@pytest.mark.parametrize("keyword, item, expected", [
+    ("ImagePositionPatient", {"valueString": "[1.5, -2, 3]"}, [1.5, -2.0, 3.0]),
+    ("ImagePositionPatient", {"valueString": "1.5\\-2\\3"}, [1.5, -2.0, 3.0]),
+    ("SeriesNumber", {"valueString": "4"}, 4),
+    ("SeriesNumber", {"valueInteger": 4}, 4),
+    ("SliceThickness", {"valueString": "2.5"}, 2.5),
+    ("SliceThickness", {"valueQuantity": {"value": 2.5, "unit": "mm"}}, 2.5),
+    ("SliceThickness", {"valueString": "n/a"}, None),
+    ("BodyPartExamined", {"valueString": "CHEST"}, "CHEST"),
+])
+def test_read_value_parses_legacy_value_strings(keyword, item, expected):
+    assert read_value(FIELDS[keyword], item) == expected
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_batch_entry_rejected_by_server(tmp_path, monkeypatch, concurrency):
+    paths = generate(str(tmp_path / "dicom"), "CT", 1, 1, 3, 32)
+    bad = pydicom.dcmread(paths[1]).SOPInstanceUID
+    dead_letter_path = tmp_path / "dead_letter.jsonl"
+    reject = lambda resource: resource.get("resourceType") == "DiagnosticReport" and resource.get("id") == bad
+    with MockFHIRServer(reject=reject) as server:
+        monkeypatch.setattr(main, "FHIR_URL", server.url)
+        monkeypatch.setattr(pipeline, "FHIR_URL", server.url)
+        processed = asyncio.run(main.main(str(tmp_path / "dicom"), bundle_type="batch", batch_size=3,
+                                          concurrency=concurrency, workers=1, manifest_path=None,
+                                          dead_letter_path=str(dead_letter_path)))
+        study = next(resource for key, resource in server.resources.items() if key.startswith("ImagingStudy/"))
+    assert len(processed) == 2
+    assert bad not in [instance["uid"] for series in study["series"] for instance in series["instance"]]
+    assert [json.loads(line)["stage"] for line in open(dead_letter_path)] == ["upload"]
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+
+import pydicom
+
+from discovery import is_dicom_file, DICOMDIR_NAME
+from main import MANIFEST_PATH, PIXEL_FORMAT, conversion_options, main as convert
+from manifest import Manifest
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two looks at the watched directories
+POLL_INTERVAL = float(os.environ.get("watch_poll_interval", 1.0))
+# A file counts as fully written once its size and mtime have not changed for this long
+SETTLE_SECONDS = float(os.environ.get("watch_settle_seconds", 2.0))
+# A study's micro-batch is converted once it holds this many files...
+BATCH_FILES = int(os.environ.get("watch_batch_files", 100))
+# ...or once its oldest file has waited this many seconds
+BATCH_SECONDS = float(os.environ.get("watch_batch_seconds", 5.0))
+# Files a batch did not convert (e.g. dead-lettered during an outage) are queued again after
+# this many seconds, doubling per failure up to watch_retry_max_seconds...
+RETRY_SECONDS = float(os.environ.get("watch_retry_seconds", 5.0))
+RETRY_MAX_SECONDS = float(os.environ.get("watch_retry_max_seconds", 300.0))
+# ...and given up on after this many failed conversions, until their directory changes again
+RETRY_ATTEMPTS = int(os.environ.get("watch_retry_attempts", 8))
+# The manifest carries shared resources and ImagingStudy aggregates from one batch to the next
+WATCH_MANIFEST_PATH = MANIFEST_PATH or "ingest.db"
+# Names senders use while a file is still being copied in
+PARTIAL_SUFFIXES = (".part", ".partial", ".tmp", ".filepart")
+
+
+def study_uid(full_path):
+    """StudyInstanceUID of a file, or None if it cannot be read (the conversion will dead-letter it)"""
+    try:
+        return str(pydicom.dcmread(full_path, stop_before_pixels=True,
+                                   specific_tags=["StudyInstanceUID"]).get("StudyInstanceUID") or "") or None
+    except Exception:
+        return None
+
+
+class DirectoryWatcher:
+    """Finds files that are new or rewritten under a directory tree, once fully written.
+
+    Only directories whose mtime changed (a file was added, removed or renamed in
+    them) are listed again, so a poll costs one stat per directory plus one per file
+    still being written, however many files the tree already holds.
+    """
+
+    def __init__(self, root, settle=SETTLE_SECONDS):
+        self.root = os.path.normpath(root)
+        self.settle = settle
+        self.directories = {}  # path: mtime_ns when last listed
+        self.known = {}  # directory: {path: (size, mtime_ns)} of the files seen settled there
+        self.pending = {}  # path: ((size, mtime_ns), monotonic time it was last seen changing)
+
+    def scan(self, directory):
+        known = self.known.get(directory, {})
+        present = {}
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self.directories:
+                    self.directories[entry.path] = None
+                continue
+            if entry.name.startswith(".") or entry.name.lower().endswith(PARTIAL_SUFFIXES) \
+                    or entry.name.upper() == DICOMDIR_NAME:
+                continue
+            if entry.path in known:
+                present[entry.path] = known[entry.path]
+            if entry.path not in self.pending:
+                stat = entry.stat()
+                if known.get(entry.path) != (stat.st_size, stat.st_mtime_ns):
+                    self.pending[entry.path] = ((stat.st_size, stat.st_mtime_ns), time.monotonic())
+        # Files deleted since (e.g. cleared from a drop box) are forgotten
+        self.known[directory] = present
+
+    def forget(self, path):
+        """Drop a settled file, so it is taken again the next time its directory is listed"""
+        self.known.get(os.path.dirname(path), {}).pop(path, None)
+
+    def poll(self):
+        """Return the paths, relative to root, that have settled since the last poll"""
+        self.directories.setdefault(self.root, None)
+        now_ns = time.time_ns()
+        for directory in list(self.directories):
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                del self.directories[directory]
+                self.known.pop(directory, None)
+                continue
+            # A directory changed within the settle time is listed again, in case its
+            # mtime did not move for a file added in the same timestamp tick
+            if mtime != self.directories[directory] or now_ns - mtime < self.settle * 1e9:
+                self.directories[directory] = mtime
+                self.scan(directory)
+
+        settled = []
+        now = time.monotonic()
+        for path, (state, changed) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != state:
+                self.pending[path] = (current, now)
+            elif now - changed >= self.settle:
+                del self.pending[path]
+                self.known.setdefault(os.path.dirname(path), {})[path] = current
+                if is_dicom_file(path):
+                    settled.append(os.path.relpath(path, self.root))
+        return settled
+
+
+class MicroBatcher:
+    """Groups settled files into one batch per (root, study), bounded in size and age"""
+
+    def __init__(self, max_files=BATCH_FILES, max_seconds=BATCH_SECONDS):
+        self.max_files = max_files
+        self.max_seconds = max_seconds
+        self.batches = {}  # (root, StudyInstanceUID): (monotonic time of the first file, [files])
+
+    def add(self, root, files):
+        for dicom_file in files:
+            key = (root, study_uid(os.path.join(root, dicom_file)))
+            self.batches.setdefault(key, (time.monotonic(), []))[1].append(dicom_file)
+
+    def ready(self, flush=False):
+        """Pop and return the (root, files) batches that are full, old enough, or all of them with flush"""
+        now = time.monotonic()
+        ready = []
+        for key, (started, files) in list(self.batches.items()):
+            if flush or len(files) >= self.max_files or now - started >= self.max_seconds:
+                del self.batches[key]
+                for start in range(0, len(files), self.max_files):
+                    ready.append((key[0], files[start:start + self.max_files]))
+        return ready
+
+
+async def watch(directories, stop=None, poll_interval=POLL_INTERVAL, settle=SETTLE_SECONDS,
+                max_files=BATCH_FILES, max_seconds=BATCH_SECONDS, manifest_path=WATCH_MANIFEST_PATH, **options):
+    """Convert DICOM files as they are dropped into directories, until stop (an asyncio.Event) is set.
+
+    Files already in the trees are picked up by the first poll. Each file is taken
+    once it has stopped changing for `settle` seconds, and grouped with the other new
+    files of its study; a study's batch is converted by main.main once it holds
+    max_files files or its first file has waited max_seconds. The remaining files
+    are converted when stop is set. options (bundle_type, concurrency, pixel_format,
+    ...) are passed on to main.main. The manifest is required: it skips files already
+    pushed unchanged and carries each study's ImagingStudy from one batch to the next.
+    A batch that raises is logged and the watch goes on. Files a batch left out of the
+    manifest are queued again with exponential backoff, up to RETRY_ATTEMPTS times.
+    Returns the number of files converted.
+    """
+    stop = stop or asyncio.Event()
+    watchers = {os.path.normpath(directory): DirectoryWatcher(directory, settle) for directory in directories}
+    batcher = MicroBatcher(max_files, max_seconds)
+    manifest = Manifest(manifest_path)
+    converted_with = conversion_options(options.get("pixel_format", PIXEL_FORMAT), options.get("images", True))
+    attempts = {}  # (root, file): failed conversions so far
+    retry_at = {}  # (root, file): monotonic time it is queued again
+    converted = 0
+    logger.info(f"Watching {', '.join(directories)} every {poll_interval}s "
+                f"(batches of up to {max_files} files or {max_seconds}s per study)")
+
+    while True:
+        stopping = stop.is_set()
+        for root, watcher in watchers.items():
+            batcher.add(root, watcher.poll())
+        now = time.monotonic()
+        for root, dicom_file in [key for key, due in retry_at.items() if due <= now]:
+            del retry_at[(root, dicom_file)]
+            batcher.add(root, [dicom_file])
+        for root, files in batcher.ready(flush=stopping):
+            started = time.perf_counter()
+            try:
+                processed_files = await convert(root, files=files, manifest_path=manifest_path, **options)
+            except Exception as e:
+                logger.error(f"Converting {len(files)} files from {root} failed: {e}")
+                REGISTRY.count("watch_batch_failures_total")
+                processed_files = []
+            converted += len(processed_files)
+            seconds = time.perf_counter() - started
+            REGISTRY.count("watch_files_total", len(files))
+            REGISTRY.observe("watch_batch_seconds", seconds)
+            logger.info(f"Converted {len(processed_files)}/{len(files)} new files from {root} in {seconds:.2f}s")
+
+            processed = set(processed_files)
+            requeued = 0
+            for dicom_file in files:
+                key = (root, dicom_file)
+                full_path = os.path.join(root, dicom_file)
+                try:
+                    # Files skipped as unchanged are not in processed_files, but are in the manifest
+                    failed = dicom_file not in processed and not manifest.is_current(full_path, converted_with)
+                except OSError:
+                    failed = False  # Removed since; nothing left to convert
+                if not failed:
+                    attempts.pop(key, None)
+                    continue
+                attempts[key] = attempts.get(key, 0) + 1
+                if attempts[key] >= RETRY_ATTEMPTS:
+                    logger.error(f"Giving up on {full_path} after {attempts.pop(key)} attempts; "
+                                 f"it is taken again when its directory changes")
+                    watchers[root].forget(full_path)
+                    continue
+                delay = min(RETRY_SECONDS * 2 ** (attempts[key] - 1), RETRY_MAX_SECONDS)
+                retry_at[key] = time.monotonic() + delay
+                requeued += 1
+            if requeued:
+                REGISTRY.count("watch_retries_total", requeued)
+                logger.warning(f"Queueing {requeued} files from {root} again with backoff")
+        if stopping:
+            if retry_at:
+                logger.warning(f"{len(retry_at)} files still waiting for a retry were not converted")
+            manifest.close()
+            return converted
+        try:
+            await asyncio.wait_for(stop.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass